@@ -0,0 +1,50 @@
+"""
+legacy_perfdata.py
+
+The perf data parser from HostMonitor before it was replaced by modules.perfdata. It is kept as a reference,
+benchmarks.perfdata compares their speed and tests.test_perfdata checks they give the same results.
+
+"""
+import re
+from slugify import slugify
+
+
+def legacy_parse_perf_data(service_id, service_output):
+    """ the perf data parser from HostMonitor before it was replaced by modules.perfdata, kept to compare against """
+    result = []
+    perf_order = ["value", "warning", "critical", "min", "max"]
+
+    # determine if there is any perf data
+    perf_string = service_output.strip().split("|")
+    if(len(perf_string) > 1):
+        # this should get each perf data value sequence
+        # this regex allows for quotes within a perf sequence
+        for p in re.finditer("(\"[^\"]*\"|'[^']*'|[\\S]+)+", perf_string[1].strip()):
+
+            # find all the numeric values
+            values = []
+            for t in re.finditer("(=|;)[+-]?((\\d+(\\.\\d+)?)|(\\.\\d+))|;", p.group()):
+                values.append(t.group()[1:])
+
+            # map the values to the appropriate keys, filter out blank values
+            mapping = {perf_order[i]: values[i] for i in range(0, len(values)) if values[i].strip() != ''}
+
+            # get the label and unit of measure
+            first_key = p.group().strip().split(";")[0].split("=")
+            unit_of_measure = first_key[1][len(mapping["value"]):]
+
+            # convert values to decimals
+            mapping = {k: float(v) for k, v in mapping.items()}
+
+            # add in the label and unit of measure
+            p_id = slugify(first_key[0]) if slugify(first_key[0].strip()) != '' else 'root'
+            mapping['id'] = f"{service_id}-{p_id}"
+            mapping['label'] = first_key[0].replace("'", "")
+
+            # only add if it exists
+            if(unit_of_measure != ""):
+                mapping['uom'] = unit_of_measure
+
+            result.append(mapping)
+
+    return result
@@ -0,0 +1,36 @@
+"""
+perfdata.py
+
+Measures how many perf data metrics per second are parsed from typical check output, by modules.perfdata and by
+the parser it replaced
+
+Run from the root of the repository:
+
+python3 -m benchmarks.perfdata --count 20000
+"""
+import argparse
+import time
+from modules.perfdata import parse_perf_data
+from benchmarks.legacy_perfdata import legacy_parse_perf_data
+
+# output both parsers handle, from a few common checks
+OUTPUT = ["OK - load average: 0.50, 0.30, 0.20|load1=0.500;4.000;8.000;0; load5=0.300;4.000;8.000;0; load15=0.200;4.000;8.000;0;",
+          "DISK OK - free space: / 3326 MB (56%);|/=2643MB;5948;5958;0;5968",
+          "OK - 12 processes|procs=12;200;250;0;",
+          "HTTP OK: HTTP/1.1 200 OK - 5120 bytes in 0.045 second response time|time=0.045s;1.0;2.0;0.0 size=5120B;;;0",
+          "PING OK - Packet loss = 0%, RTA = 0.80 ms|rta=0.800ms;100.000;500.000;0; pl=0%;20;60;0"]
+
+parser = argparse.ArgumentParser(description='Perf data parser benchmark')
+parser.add_argument('-n', '--count', type=int, default=20000, help="Number of times to parse each output, %(default)d by default")
+args = parser.parse_args()
+
+metrics = sum(len(parse_perf_data("host-service", o)) for o in OUTPUT) * args.count
+
+for name, parse in [("perfdata", parse_perf_data), ("legacy", legacy_parse_perf_data)]:
+    start = time.perf_counter()
+    for i in range(args.count):
+        for o in OUTPUT:
+            parse("host-service", o)
+    elapsed = time.perf_counter() - start
+
+    print(f"{name}: {metrics / elapsed:.0f} metrics/s")
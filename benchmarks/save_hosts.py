@@ -0,0 +1,109 @@
+"""
+save_hosts.py
+
+Measures saving a check cycle of hosts to Redis, one host at a time the way they were saved before batching and as
+one batch with save_hosts(). Reports the round trips to the server and how long each save took, the first cycle creates the time
+series and later cycles add to them. A delay can be added to each round trip to see how a remote server would do.
+
+The benchmark hosts are deleted afterwards, but use a Redis server the monitor isn't using.
+
+Run from the root of the repository:
+
+python3 -m benchmarks.save_hosts --database 127.0.0.1 --hosts 500 --rtt 1
+"""
+import argparse
+import time
+import redis.connection
+from modules.history import DBKeys, DBQueries, RedisHistory
+
+parser = argparse.ArgumentParser(description='Redis save benchmark')
+parser.add_argument('-d', '--database', default="127.0.0.1", help="IP or hostname of the Redis database, %(default)s by default")
+parser.add_argument('-H', '--hosts', type=int, default=200, help="Number of hosts in each cycle, %(default)d by default")
+parser.add_argument('-s', '--services', type=int, default=5, help="Number of services on each host, %(default)d by default")
+parser.add_argument('-r', '--rtt', type=float, default=0, help="Milliseconds to add to each round trip, %(default)s by default")
+parser.add_argument('-n', '--cycles', type=int, default=3, help="Number of check cycles to save, %(default)d by default")
+args = parser.parse_args()
+
+# count each command or pipeline sent to the server
+round_trips = 0
+send_packed_command = redis.connection.Connection.send_packed_command
+
+
+def counted_send(self, command, check_health=True):
+    global round_trips
+
+    round_trips = round_trips + 1
+    time.sleep(args.rtt / 1000)
+    return send_packed_command(self, command, check_health)
+
+
+redis.connection.Connection.send_packed_command = counted_send
+
+
+def legacy_save_host(history, host_id, host_status):
+    """ saves one host the way RedisHistory.save_host() did before hosts were saved in batches, a transaction for
+    the host and its indexes then a command for each perf data value """
+    def replace_host(pipe):
+        old_services = pipe.json().get(DBKeys.HOST.value.format(host_id=host_id), DBQueries.GET_SERVICES.value) or []
+
+        # replace the host and its index entries in one transaction
+        pipe.multi()
+        for s in old_services:
+            pipe.hdel(DBKeys.SERVICE_HOSTS.value, s['id'])
+            pipe.srem(DBKeys.RETURN_CODE.value.format(return_code=s['return_code']), s['id'])
+            for tag in s.get('tags', []):
+                pipe.srem(DBKeys.TAG.value.format(tag_id=tag), s['id'])
+
+        pipe.json().set(DBKeys.HOST.value.format(host_id=host_id), "$", host_status)
+        pipe.sadd(DBKeys.HOST_IDS.value, host_id)
+
+        for s in host_status['services']:
+            pipe.hset(DBKeys.SERVICE_HOSTS.value, s['id'], host_id)
+            pipe.sadd(DBKeys.RETURN_CODE.value.format(return_code=s['return_code']), s['id'])
+            for tag in s.get('tags', []):
+                pipe.sadd(DBKeys.TAG.value.format(tag_id=tag), s['id'])
+
+    # the host key is watched so the indexes can't be changed by another save in between
+    history.db.transaction(replace_host, DBKeys.HOST.value.format(host_id=host_id))
+
+    # save perf data, time series use millisecond timestamps
+    unix_time = int(host_status['last_check'] * 1000)
+    for s in host_status['services']:
+        for p in s.get('perf_data', []):
+            if(history.db.exists(p['id']) == 0):
+                # save for 30 days
+                history.db.ts().create(p['id'], retention_msecs=(86400000 * 30))
+
+            history.db.ts().add(p['id'], unix_time, p['value'])
+
+
+def make_batch(name, last_check):
+    return [{"id": f"{name}-{i}", "name": f"{name} {i}", "last_check": last_check, "alive": 0,
+             "services": [{"id": f"{name}-{i}-{j}", "name": f"service {j}", "return_code": 0, "tags": ["benchmark"], "state": "CONFIRMED",
+                           "last_state_change": last_check,
+                           "perf_data": [{"id": f"{name}-{i}-{j}-{k}", "value": k} for k in range(2)]} for j in range(args.services)]}
+            for i in range(args.hosts)]
+
+
+history = RedisHistory(args.database)
+existing = history.list_hosts()
+start_time = int(time.time()) - args.cycles
+
+try:
+    for name, save in [("per host", lambda batch: [legacy_save_host(history, h['id'], h) for h in batch]), ("batched", history.save_hosts)]:
+        for cycle in range(args.cycles):
+            batch = make_batch(f"benchmark-{name.replace(' ', '-')}", start_time + cycle)
+
+            round_trips = 0
+            start = time.perf_counter()
+            save(batch)
+            elapsed = time.perf_counter() - start
+
+            series = "new series" if cycle == 0 else "existing series"
+            print(f"{name} cycle {cycle + 1} ({series}): {round_trips} round trips, {elapsed * 1000:.0f} ms")
+finally:
+    # remove the benchmark hosts and their time series
+    history.set_hosts(existing)
+    keys = list(history.db.scan_iter(match="benchmark-*"))
+    if(keys):
+        history.db.delete(*keys)
@@ -0,0 +1,49 @@
+"""
+spawn.py
+
+Measures how many check commands per second the ServiceRunner can start, through the spawn server and by starting
+each command directly from the monitor. A ballast of touched memory makes the monitor process bigger, which is what
+makes forking it slower.
+
+Run from the root of the repository:
+
+python3 -m benchmarks.spawn --ballast 1024 --no-vfork
+"""
+import argparse
+import subprocess
+import time
+import modules.spawner as spawner
+from modules.runner import ServiceRunner
+
+parser = argparse.ArgumentParser(description='Spawn server benchmark')
+parser.add_argument('-n', '--count', type=int, default=2000, help="Number of commands to run, %(default)d by default")
+parser.add_argument('-c', '--concurrency', type=int, default=8, help="Commands to run at once, %(default)d by default")
+parser.add_argument('-b', '--ballast', type=int, default=50, help="MB of memory to add to the monitor process, %(default)d by default")
+parser.add_argument('--no-vfork', action='store_true', help="Start commands directly with fork/exec, instead of letting Python use vfork")
+args = parser.parse_args()
+
+ballast = bytearray(args.ballast * 1024 * 1024)
+for i in range(0, len(ballast), 4096):
+    ballast[i] = 1
+
+runners = {"spawn server": ServiceRunner(args.concurrency)}
+
+# the next runner starts commands from this process
+spawner.is_supported = lambda: False
+if(args.no_vfork):
+    subprocess._USE_VFORK = False
+    subprocess._USE_POSIX_SPAWN = False
+runners['direct'] = ServiceRunner(args.concurrency)
+
+for name, runner in list(runners.items()) * 2:
+    # every command is different so none of them share a result
+    runner.run_all([(['/bin/true', f"warmup-{i}"], 10) for i in range(50)], args.concurrency)
+    runner.new_cycle()
+
+    start = time.monotonic()
+    results = runner.run_all([(['/bin/true', str(i)], 10) for i in range(args.count)], args.concurrency)
+    elapsed = time.monotonic() - start
+    runner.new_cycle()
+
+    failed = len([r for r in results if r.returncode != 0])
+    print(f"{name}: {args.count / elapsed:.0f} spawns/s ({failed} failed)")
@@ -0,0 +1,63 @@
+"""
+sqlite.py
+
+Measures saving a check cycle to a SQLite history database and the lookups made by the web interface, for a few
+sizes of install. Each size gets a new database, filled with one cycle before anything is timed.
+
+Run from the root of the repository:
+
+python3 -m benchmarks.sqlite --hosts 100 1000 10000
+"""
+import argparse
+import os.path
+import tempfile
+import time
+from modules.sqlite_history import SQLiteHistory
+
+parser = argparse.ArgumentParser(description='SQLite history benchmark')
+parser.add_argument('-H', '--hosts', type=int, nargs='+', default=[100, 1000, 10000], help="Numbers of hosts to test, %(default)s by default")
+parser.add_argument('-s', '--services', type=int, default=5, help="Number of services on each host, %(default)d by default")
+parser.add_argument('-n', '--count', type=int, default=3, help="Number of times to time each call, the best is shown. %(default)d by default")
+args = parser.parse_args()
+
+
+def make_batch(hosts, last_check):
+    """ every tenth host is tagged web, the first service of the first ten hosts is critical """
+    return [{"id": f"host-{i}", "name": f"host {i}", "last_check": last_check, "alive": 0, "overall_status": 0,
+             "services": [{"id": f"host-{i}-{j}", "name": f"service {j}", "host": {"id": f"host-{i}", "name": f"host {i}"},
+                           "return_code": 2 if i < 10 and j == 0 else 0, "tags": ["web" if i % 10 == 0 else "other"], "state": "CONFIRMED",
+                           "last_state_change": last_check, "perf_data": [{"id": f"host-{i}-{j}-{k}", "value": k} for k in range(2)]}
+                          for j in range(args.services)]}
+            for i in range(hosts)]
+
+
+def best_time(call):
+    """ :returns: the fastest of the timed calls, in milliseconds """
+    result = None
+    for i in range(args.count):
+        start = time.perf_counter()
+        call()
+        elapsed = (time.perf_counter() - start) * 1000
+        result = elapsed if result is None else min(result, elapsed)
+
+    return result
+
+
+for hosts in args.hosts:
+    with tempfile.TemporaryDirectory() as path:
+        history = SQLiteHistory(os.path.join(path, "history.db"))
+        last_check = int(time.time()) - args.count * 60
+        history.save_hosts(make_batch(hosts, last_check))
+
+        def save_cycle():
+            global last_check
+
+            last_check = last_check + 60
+            history.save_hosts(make_batch(hosts, last_check))
+
+        results = {"save_hosts": best_time(save_cycle), "get_hosts": best_time(history.get_hosts),
+                   "get_host": best_time(lambda: history.get_host("host-5")),
+                   "get_services (issues)": best_time(lambda: history.get_services([1, 2])),
+                   "get_tag": best_time(lambda: history.get_tag("web")), "get_service": best_time(lambda: history.get_service("host-5-1"))}
+
+        print(f"{hosts} hosts: " + ", ".join(f"{name} {elapsed:.1f} ms" for name, elapsed in results.items()))
@@ -0,0 +1,67 @@
+"""
+templates.py
+
+Measures how long it takes to render the command, arguments, and output filter of every service in a check cycle,
+using the templates the monitor compiles when the config is loaded and compiling each template every time it's used.
+The hosts in the example config are copied to make a bigger config.
+
+Run from the root of the repository:
+
+python3 -m benchmarks.templates --copies 20
+"""
+import argparse
+import copy
+import logging
+import os.path
+import tempfile
+import time
+import modules.utils as utils
+from modules.monitor import DEFAULT_OUTPUT_FILTER, HostMonitor
+from modules.sqlite_history import SQLiteHistory
+
+
+class Uncached(dict):
+    """a template cache that never keeps anything, so every template is compiled when it's rendered"""
+
+    def __setitem__(self, key, value):
+        pass
+
+
+parser = argparse.ArgumentParser(description='Template render benchmark')
+parser.add_argument('-f', '--file', default=os.path.join(utils.DIR_PATH, 'install', 'monitor_example.yaml'),
+                    help="Path to the config file, %(default)s by default")
+parser.add_argument('-c', '--copies', type=int, default=20, help="Number of copies of each host in the config, %(default)d by default")
+parser.add_argument('-n', '--cycles', type=int, default=5, help="Number of check cycles to time, %(default)d by default")
+args = parser.parse_args()
+
+logging.basicConfig(level=logging.WARNING)
+
+yaml_check = utils.load_config_file(args.file)
+if(not yaml_check['valid']):
+    parser.error(f"{args.file} is not valid: {yaml_check['errors']}")
+
+config = yaml_check['yaml']
+config['hosts'] = [dict(copy.deepcopy(h), name=f"{h['name']} {i}") for i in range(args.copies) for h in config['hosts']]
+
+with tempfile.TemporaryDirectory() as path:
+    monitor = HostMonitor(SQLiteHistory(os.path.join(path, "history.db")), config)
+    create_service_call = monitor._HostMonitor__create_service_call
+    render_template = monitor._HostMonitor__render_template
+    services = [(s, h.config) for h in monitor.hosts.values() for s in h.get_services()]
+
+    def cycle():
+        for service, host_config in services:
+            create_service_call(service, host_config)
+            render_template(service.get('output_filter', DEFAULT_OUTPUT_FILTER), {"value": "OK|time=1s", "return_code": 0})
+
+    compiled = monitor._templates
+    for name, templates in [("compiled", compiled), ("uncompiled", Uncached())]:
+        monitor._templates = templates
+        cycle()
+
+        start = time.perf_counter()
+        for i in range(args.cycles):
+            cycle()
+        elapsed = (time.perf_counter() - start) / args.cycles
+
+        print(f"{name}: {elapsed * 1000:.1f} ms per cycle of {len(services)} services, {elapsed * 1000000 / len(services):.0f} us per service")
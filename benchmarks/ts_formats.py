@@ -0,0 +1,74 @@
+"""
+ts_formats.py
+
+Measures reading a perf data series and serializing it in each format of the /api/time endpoint, along with the size
+of each response before and after gzip. A SQLite database is filled with one point a minute, the raw points are
+read back so the response holds every point.
+
+Run from the root of the repository:
+
+python3 -m benchmarks.ts_formats --days 30
+"""
+import argparse
+import datetime
+import gzip
+import json
+import os.path
+import tempfile
+import time
+from modules.sqlite_history import SQLiteHistory
+
+parser = argparse.ArgumentParser(description='Time series format benchmark')
+parser.add_argument('--days', type=int, default=30, help="Days of points to read, %(default)d by default")
+parser.add_argument('-n', '--count', type=int, default=5, help="Number of times to time each format, the best is shown. %(default)d by default")
+args = parser.parse_args()
+
+
+def per_point_json(history, key, start, end, points):
+    """ the JSON response as it was built before the columnar formats, with a Python loop over each point """
+    columns = history.get_ts_columns(key, start, end, points)
+    result = {"times": [], "values": [], "unix_times": []}
+
+    for t, v in zip(columns['unix_times'], columns['values']):
+        result['unix_times'].append(t)
+        result['times'].append(datetime.datetime.fromtimestamp(t).strftime("%m/%d/%y %H:%M:%S"))
+        result['values'].append(v)
+
+    return json.dumps(result).encode()
+
+
+def json_format(history, key, start, end, points):
+    return json.dumps(history.get_ts_data(key, start, end, points)).encode()
+
+
+def columnar_format(history, key, start, end, points):
+    columns = history.get_ts_columns(key, start, end, points)
+
+    return json.dumps({"unix_times": columns['unix_times'].tolist(), "values": columns['values'].tolist(),
+                       "resolution": columns['resolution']}).encode()
+
+
+def binary_format(history, key, start, end, points):
+    columns = history.get_ts_columns(key, start, end, points)
+
+    return columns['unix_times'].tobytes() + columns['values'].tobytes()
+
+
+with tempfile.TemporaryDirectory() as path:
+    history = SQLiteHistory(os.path.join(path, "history.db"))
+
+    end = int(time.time())
+    start = end - args.days * 86400
+    points = args.days * 1440
+    history.save_perf_data([{"last_check": start + i * 60, "services": [{"perf_data": [{"id": "benchmark", "value": (i % 1000) / 7}]}]}
+                            for i in range(points)])
+
+    for name, serialize in [("json, per point", per_point_json), ("json", json_format), ("columnar", columnar_format), ("binary", binary_format)]:
+        best = None
+        for i in range(args.count):
+            begin = time.perf_counter()
+            body = serialize(history, "benchmark", start, end, points)
+            elapsed = time.perf_counter() - begin
+            best = elapsed if best is None else min(best, elapsed)
+
+        print(f"{name}: {best * 1000:.1f} ms, {len(body)} bytes, {len(gzip.compress(body))} gzipped")
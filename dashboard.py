@@ -11,7 +11,6 @@ sudo python3 dashboard.py -h
 """
 
 
-import asyncio
 import configargparse
 import datetime
 import logging
@@ -24,18 +23,85 @@ import os.path
 import modules.utils as utils
 from natsort import natsorted
 from modules.monitor import HostMonitor
-from modules.history import HostHistory
+from modules.archive import PerfArchive
+from modules.cache import HistoryCache
+from modules.history import RedisHistory, PERF_POINTS
+from modules.index import ServiceIndex
 from modules.notifications import NotificationGroup
+from modules.sqlite_history import SQLiteHistory
+from modules.writer import HistoryWriter
+from modules.stats import SORT_KEYS
+from modules.events import HOST_UP, HOST_DOWN, SERVICE_CHANGED
+from modules.exceptions import HostParentError
 from flask import Flask, flash, render_template, jsonify, redirect, request, Response
 from slugify import slugify
 
+# response formats of the time series API
+TS_FORMATS = ['json', 'columnar', 'binary']
+
+# database argument prefix to use a SQLite database file
+SQLITE_PREFIX = 'sqlite:'
+
+# seconds to wait for queued hosts to be saved when exiting
+EXIT_SAVE_TIMEOUT = 10
+
 
 # function to handle when the is killed and exit gracefully
 def signal_handler(signum, frame):
     logging.debug('Exiting Program')
+
+    # save anything still waiting
+    if(writer is not None and not writer.flush(EXIT_SAVE_TIMEOUT)):
+        logging.warning(f"Exiting with {writer.get_stats()['pending']} hosts not saved")
     sys.exit(0)
 
 
+# function to reload the host configuration when SIGHUP is received
+def reload_handler(signum, frame):
+    # reload from another thread so the signal doesn't interrupt a running check
+    threading.Thread(name='Config Reload', target=reload_config).start()
+
+
+def reload_config():
+    yaml_check = utils.load_config_file(args.file)
+
+    if(yaml_check['valid']):
+        logging.info('Reloading host configuration')
+
+        try:
+            monitor.load_config(yaml_check['yaml'])
+            service_index.set_hosts(monitor.get_hosts())
+        except HostParentError as e:
+            logging.error(f"{e}, keeping the current configuration")
+    else:
+        logging.error("Error reading configuration file, keeping the current configuration")
+        logging.error(yaml_check['errors'])
+
+
+def display_service(service):
+    """returns a copy of the service with any timestamps formatted for display"""
+    result = dict(service)
+
+    if('last_state_change' in result):
+        result['last_state_change'] = utils.format_timestamp(result['last_state_change'])
+
+    return result
+
+
+def display_host(host):
+    """returns a copy of the host, including services, with any timestamps formatted for display"""
+    result = dict(host)
+
+    for key in ['last_check', 'next_check']:
+        if(key in result):
+            result[key] = utils.format_timestamp(result[key])
+
+    if('services' in result):
+        result['services'] = [display_service(s) for s in result['services']]
+
+    return result
+
+
 def webapp_thread(port_number, config_file, config_yaml, notifier_configured, debugMode=False, logHandlers=[]):
     app = Flask(import_name="trash-panda", static_folder=os.path.join(utils.DIR_PATH, 'web', 'static'),
                 template_folder=os.path.join(utils.DIR_PATH, 'web', 'templates'))
@@ -68,12 +134,12 @@ def webapp_thread(port_number, config_file, config_yaml, notifier_configured, de
 
     @app.route('/status/host/<id>')
     def host_status(id):
-        result = history.get_host(id)
+        result = cache.get_host(id)
 
         if(result is not None):
             # set if a notifier is configured to toggle silent mode controls
             doc_file = os.path.join(config_yaml['config']['docs_dir'], f"{id}.md")
-            return render_template("host_status.html", host=result, page_title='Host Status', has_notifier=notifier_configured,
+            return render_template("host_status.html", host=display_host(result), page_title='Host Status', has_notifier=notifier_configured,
                                    docs=utils.load_documentation(doc_file), doc_file=doc_file, tags=config_yaml['tags'])
         else:
             flash('Host page not found', 'warning')
@@ -85,7 +151,7 @@ def webapp_thread(port_number, config_file, config_yaml, notifier_configured, de
 
     @app.route('/status/tag/<tag_id>')
     def tags(tag_id):
-        tag = history.get_tag(tag_id)
+        tag = service_index.get_tag(tag_id)
         tag['name'] = config_yaml['tags'][tag_id]['name']
 
         return render_template("services.html", url=f"/api/status/tag/{tag_id}", page_title=f"{tag['name']}")
@@ -101,7 +167,7 @@ def webapp_thread(port_number, config_file, config_yaml, notifier_configured, de
         if(request.args.get('minutes') is not None):
             minutes = int(request.args.get('minutes'))
 
-        service = history.get_service(service_id)
+        service = service_index.get_service(service_id)
         return render_template('performance_data.html', service=service, minutes=minutes,
                                page_title=f"{service['host']['name']} {service['name']}")
 
@@ -154,7 +220,7 @@ def webapp_thread(port_number, config_file, config_yaml, notifier_configured, de
 
     @app.route('/api/list/hosts', methods=['GET'])
     def list_hosts():
-        return jsonify(history.list_hosts())
+        return jsonify(cache.list_hosts())
 
     @app.route('/api/list/tags', methods=['GET'])
     def list_tags():
@@ -163,9 +229,9 @@ def webapp_thread(port_number, config_file, config_yaml, notifier_configured, de
     @app.route('/api/status/hosts', methods=['GET'])
     def status():
         # get a list of hosts
-        hosts = history.get_hosts()
+        hosts = cache.get_hosts()
 
-        return jsonify(sorted(hosts, key=lambda o: o['name']))
+        return jsonify(sorted([display_host(h) for h in hosts], key=lambda o: o['name']))
 
     @app.route('/api/status/summary', methods=['GET'])
     def overall_status():
@@ -173,7 +239,7 @@ def webapp_thread(port_number, config_file, config_yaml, notifier_configured, de
         error_count = 0
 
         # pull in all the hosts and get their overall status
-        hosts = history.get_hosts()
+        hosts = cache.get_hosts()
         services = []
         for host in hosts:
             # catch for rare cases where host status hasn't been calculated yet
@@ -185,17 +251,17 @@ def webapp_thread(port_number, config_file, config_yaml, notifier_configured, de
                     error_count = error_count + 1
 
         # get services in error
-        services = history.get_services([1, 2])
+        services = service_index.get_services([1, 2])
 
         return jsonify({"total_hosts": len(hosts), "hosts_with_errors": error_count, "services_with_errors": len(services),
                         "overall_status": overall_status, "overall_status_description": utils.SERVICE_STATUSES[overall_status],
-                        "services": services})
+                        "services": [display_service(s) for s in services]})
 
     @app.route('/api/status/host/<host_id>', methods=['GET'])
     def get_host(host_id):
-        host = history.get_host(host_id)
+        host = cache.get_host(host_id)
 
-        return jsonify(host)
+        return jsonify(display_host(host))
 
     @app.route('/api/status/services')
     def get_services_by_query():
@@ -208,19 +274,19 @@ def webapp_thread(port_number, config_file, config_yaml, notifier_configured, de
         if(request.args.get('service_filter') is not None):
             service_filter = request.args.get('service_filter')
 
-        services = history.get_services(return_codes, service_filter)
+        services = service_index.get_services(return_codes, service_filter)
 
         # sort by return code, then name
-        services = sorted(services, key=lambda o: (o['return_code'] * -1, o['host']['name']))
+        services = sorted([display_service(s) for s in services], key=lambda o: (o['return_code'] * -1, o['host']['name']))
 
         return jsonify({"return_codes": return_codes, "service_filter": service_filter, "services": services})
 
     @app.route('/api/status/tag/<tag_id>', methods=['GET'])
     def get_tag(tag_id):
-        tag = history.get_tag(tag_id)
+        tag = service_index.get_tag(tag_id)
 
         # convert services to an array
-        tag['services'] = sorted(tag['services'], key=lambda o: o['host']['name'])
+        tag['services'] = sorted([display_service(s) for s in tag['services']], key=lambda o: o['host']['name'])
 
         return jsonify(tag)
 
@@ -235,9 +301,77 @@ def webapp_thread(port_number, config_file, config_yaml, notifier_configured, de
         if(start is None):
             start = end - 3600
 
-        tag = history.get_ts_data(id, start, end)
+        aggregation = request.args.get('aggregation')
 
-        return jsonify(tag)
+        try:
+            points = int(request.args.get('points', PERF_POINTS))
+            bucket = int(request.args['bucket']) if 'bucket' in request.args else None
+        except ValueError:
+            points = bucket = 0
+
+        if(points <= 0 or (bucket is not None and bucket <= 0)):
+            return jsonify({"success": False, "message": "points and bucket must be whole numbers greater than 0"}), 400
+
+        if(aggregation is not None and aggregation not in history.aggregations):
+            return jsonify({"success": False, "message": f"aggregation must be one of {', '.join(history.aggregations)}"}), 400
+
+        ts_format = request.args.get('format', 'json')
+
+        if(ts_format not in TS_FORMATS):
+            return jsonify({"success": False, "message": f"format must be one of {', '.join(TS_FORMATS)}"}), 400
+
+        # ranges older than the database keeps are read from the archive, when there is one
+        series = archive if archive is not None else history
+
+        if(ts_format == 'json'):
+            return jsonify(series.get_ts_data(id, start, end, points, aggregation, bucket))
+
+        columns = series.get_ts_columns(id, start, end, points, aggregation, bucket)
+        if(ts_format == 'columnar'):
+            return jsonify({"unix_times": columns['unix_times'].tolist(), "values": columns['values'].tolist(), "resolution": columns['resolution']})
+
+        # binary - all the times then all the values, as little endian float64
+        if(sys.byteorder != 'little'):
+            columns['unix_times'].byteswap()
+            columns['values'].byteswap()
+
+        return Response(columns['unix_times'].tobytes() + columns['values'].tobytes(), mimetype='application/octet-stream',
+                        headers={"X-Points": str(len(columns['values'])), "X-Resolution": str(columns['resolution'])})
+
+    @app.route('/api/stats/checks', methods=['GET'])
+    def get_check_stats():
+        minutes = int(request.args.get('minutes', 60))
+        top = int(request.args.get('top', 10))
+        sort = request.args.get('sort', 'cpu_time')
+
+        if(sort not in SORT_KEYS):
+            return jsonify({"success": False, "message": f"sort must be one of {', '.join(SORT_KEYS)}"}), 400
+
+        return jsonify(monitor.stats.get_top(minutes, top, sort))
+
+    @app.route('/api/stats/schedule', methods=['GET'])
+    def get_schedule_stats():
+        minutes = int(request.args.get('minutes', 60))
+
+        if(minutes < 1):
+            return jsonify({"success": False, "message": "minutes must be at least 1"}), 400
+
+        return jsonify(monitor.get_schedule_load(minutes))
+
+    @app.route('/api/stats/cache', methods=['GET'])
+    def get_cache_stats():
+        return jsonify(cache.get_stats())
+
+    @app.route('/api/stats/writer', methods=['GET'])
+    def get_writer_stats():
+        return jsonify(writer.get_stats())
+
+    @app.route('/api/stats/archive', methods=['GET'])
+    def get_archive_stats():
+        if(archive is None):
+            return jsonify({"success": False, "message": "the performance data archive is not enabled"}), 404
+
+        return jsonify(archive.get_stats())
 
     @app.route('/api/command/check_now/<id>', methods=['POST'])
     def check_host_now(id):
@@ -245,22 +379,22 @@ def webapp_thread(port_number, config_file, config_yaml, notifier_configured, de
 
         if(result['success']):
             # update the next check time in the DB as well
-            aHost = history.get_host(id)
-            aHost['next_check'] = result['next_check']
-            history.save_host(id, aHost, update_perf_data=False)
+            writer.update_host(id, {"next_check": result['next_check']})
+
+            result['next_check'] = utils.format_timestamp(result['next_check'])
 
         return jsonify(result)
 
     @app.route('/api/command/silence_host/<id>/<minutes>', methods=['POST'])
     def silence_host(id, minutes):
-        until = datetime.datetime.now() + datetime.timedelta(minutes=int(minutes))
+        until = time.time() + (int(minutes) * 60)
         result = monitor.silence_host(id, until)
 
         if(result['success']):
             # update the host in the history DB as well
-            aHost = history.get_host(id)
-            aHost['silenced'] = result['is_silenced']
-            history.save_host(id, aHost, update_perf_data=False)
+            writer.update_host(id, {"silenced": result['is_silenced']})
+
+            result['until'] = utils.format_timestamp(result['until'])
 
         return jsonify(result)
 
@@ -340,26 +474,21 @@ def webapp_thread(port_number, config_file, config_yaml, notifier_configured, de
     app.run(debug=debugMode, host='0.0.0.0', port=port_number, use_reloader=False)
 
 
-async def check_notifications(notify, old_host, new_host):
-    """check if any service statuses have changed and send notifications
-    this method will be called asynchronously through asynio
-    """
-    # make sure old host has values
-    if(len(old_host) > 0):
-        # check if the host is up at all
-        if(new_host['alive'] != old_host['alive']):
-            notify.notify_host(new_host, new_host['alive'])
+def send_notifications(events):
+    """sends notifications for host status and confirmed service changes in this round of checks"""
+    for e in events:
+        if(e.type not in [HOST_UP, HOST_DOWN, SERVICE_CHANGED]):
+            continue
+
+        if(e.host['unreachable']):
+            logging.info(f"{ e.host['name'] } is unreachable, skipping notifications")
+        elif(e.host['silenced']):
+            logging.info(f"{ e.host['name'] } is in silent mode, skipping notifications")
+        elif(e.type == SERVICE_CHANGED):
+            notify.notify_service(e.host, e.service)
         else:
-            # if service list isn't the same just skip checking for now
-            if(len(new_host['services']) == len(old_host['services'])):
-                for i in range(0, len(new_host['services'])):
-                    # # check the service statuses - make sure it's confirmed before notifying
-                    if((new_host['services'][i]['return_code'] != old_host['services'][i]['return_code'] and
-                        new_host['services'][i]['state'] == utils.CONFIRMED_STATE) or
-                       (old_host['services'][i]['state'] == utils.UNCONFIRMED_STATE and
-                       new_host['services'][i]['state'] == utils.CONFIRMED_STATE)):
-                        # something has changed in this service's status
-                        notify.notify_service(new_host, new_host['services'][i])
+            notify.notify_host(e.host, e.host['alive'])
+
 
 # parse the CLI args
 parser = configargparse.ArgumentParser(description='Trash Panda')
@@ -370,11 +499,14 @@ parser.add_argument('-f', '--file', default='conf/monitor.yaml',
 parser.add_argument('-p', '--port', default=5000,
                     help="Port number to run the web server on, %(default)d by default")
 parser.add_argument('-d', '--database', default="127.0.0.1",
-                    help="IP or hostname of Redis database, %(default)s by default")
+                    help="IP or hostname of Redis database, %(default)s by default. Use sqlite:<path> for a local SQLite database file instead")
+parser.add_argument('-a', '--archive',
+                    help="Directory to archive performance data in, kept after the database removes it. Not archived by default")
 parser.add_argument('-D', '--debug', action='store_true',
                     help='If the program should run in debug mode')
 
 args = parser.parse_args()
+writer = None
 
 # add hooks for interrupt signal
 signal.signal(signal.SIGTERM, signal_handler)
@@ -390,7 +522,23 @@ logging.basicConfig(datefmt='%m/%d %H:%M:%S',
 logging.getLogger('asyncio').setLevel(logging.WARNING)  # only show warning or above from this module
 
 # connect to redis DB
-history = HostHistory(args.database)
+if(args.database.startswith(SQLITE_PREFIX)):
+    history = SQLiteHistory(args.database[len(SQLITE_PREFIX):])
+else:
+    history = RedisHistory(args.database)
+history.migrate_hosts()
+history.migrate_timestamps()
+
+# status lookups from the web interface are cached until the hosts are saved again
+cache = HistoryCache(history)
+
+# check results are saved in the background
+writer = HistoryWriter(history)
+
+# performance data is copied to the archive in the background
+archive = None
+if(args.archive is not None):
+    archive = PerfArchive(history, args.archive)
 
 # load the config file
 yaml_check = utils.load_config_file(args.file)
@@ -411,6 +559,16 @@ if('notifications' in yaml_file['config']):
 logging.info('Starting monitoring check daemon')
 monitor = HostMonitor(history, yaml_file)
 
+# service queries from the web interface are answered from the saved check results, updated after each batch is saved so they match host lookups
+service_index = ServiceIndex()
+service_index.load(history.get_services([0, 1, 2, 3]))
+writer.add_listener(service_index.update)
+signal.signal(signal.SIGHUP, reload_handler)
+
+# notifications are sent from the change events of each round of checks
+if(notify is not None):
+    monitor.events.add_listener(send_notifications)
+
 # start the web app
 logging.info('Starting Trash Panda Web Service')
 webAppThread = threading.Thread(name='Web App', target=webapp_thread,
@@ -422,18 +580,8 @@ while 1:
     logging.debug("Running host check")
     status = monitor.check_hosts()
 
-    for host in status:
-        # send notifications, if there are any
-        if(notify is not None):
-            if(not host['silenced']):
-                asyncio.run(check_notifications(notify, history.get_host(host['id']), host))
-            else:
-                logging.info(f"{ host['name'] } is in silent mode, skipping notifications")
-
-        # save the updated host
-        history.save_host(host['id'], host)
+    # queue the updated hosts to be saved, along with the last time this loop ran
+    writer.put(status)
 
     logging.debug("Host check complete")
-    # record the last time this loop ran
-    history.save_last_check()
-    time.sleep(60 - datetime.datetime.now().second)  # sleep until the top of the next minute
+    monitor.wait(60)  # sleep until the next host is due, at most a minute so the health check stays current
@@ -0,0 +1,255 @@
+"""
+archive.py
+
+Copies perf data from the history database to compressed segment files on disk, so perf data can be kept
+longer than the database keeps it without using more database memory
+
+"""
+import bisect
+import datetime
+import itertools
+import logging
+import math
+import mmap
+import os
+import os.path
+import statistics
+import struct
+import sys
+import threading
+import time
+import urllib.parse
+import zlib
+from array import array
+from modules.history import bucket_size, ts_data, PERF_COMPACTION_TYPE, PERF_POINTS, PERF_RAW_RESOLUTION, PERF_RETENTION
+
+# a segment file holds one day of one series, days start at midnight UTC
+SEGMENT_DAY = 86400000
+SEGMENT_EXTENSION = ".seg"
+
+# magic, number of points, compressed size of the times, compressed size of the values
+SEGMENT_HEADER = struct.Struct("<4sIII")
+SEGMENT_MAGIC = b"TPA1"
+
+# seconds between looking for days to archive
+ARCHIVE_INTERVAL = 3600
+
+# milliseconds to wait after a day ends before archiving it, for checks still being saved
+ARCHIVE_DELAY = 3600000
+
+# aggregation types that can be worked out from the archived values, each is given the values in one bucket
+ARCHIVE_AGGREGATIONS = {"avg": lambda v: sum(v) / len(v), "sum": sum, "min": min, "max": max, "range": lambda v: max(v) - min(v),
+                        "count": len, "first": lambda v: v[0], "last": lambda v: v[-1],
+                        "std.p": statistics.pstdev, "std.s": lambda v: statistics.stdev(v) if len(v) > 1 else 0,
+                        "var.p": statistics.pvariance, "var.s": lambda v: statistics.variance(v) if len(v) > 1 else 0}
+
+
+class PerfArchive:
+    """
+    Copies each day of every perf data series from the HostHistory database to a segment file once the day is over,
+    from its own thread. Segments hold the point times as deltas and the values as floats in two columns, each
+    zlib compressed. The database still removes points after its own retention, time ranges reaching past this
+    are read from the segments instead. Archived days are kept until the files are deleted.
+    """
+    path = None
+    history = None
+    _stats = None
+
+    def __init__(self, history, path):
+        """
+        :param history: a HostHistory object to archive the perf data of
+        :param path: the directory to save the segment files in, created if it doesn't exist
+        """
+        self.history = history
+        self.path = path
+        self._stats = {"runs": 0, "segments": 0, "points": 0, "errors": 0, "last_run_time": 0}
+
+        os.makedirs(path, exist_ok=True)
+        threading.Thread(name='Perf Archiver', target=self.__run, daemon=True).start()
+
+    def get_ts_data(self, key, start, end, points=PERF_POINTS, aggregation=None, bucket=None):
+        """ gets the values of a perf data series within a time range along with formatted times, see get_ts_columns() """
+        return ts_data(self.get_ts_columns(key, start, end, points, aggregation, bucket))
+
+    def get_ts_columns(self, key, start, end, points=PERF_POINTS, aggregation=None, bucket=None):
+        """ gets the values of a perf data series within a time range, see HostHistory.get_ts_columns(). The part of the range
+        older than the database retention is read from the archive, and the rest from the database, as long as the series has
+        been archived and the aggregation can be worked out from the archived values
+        """
+        live_start = time.time() * 1000 - PERF_RETENTION
+        if(start * 1000 >= live_start or (aggregation is not None and aggregation not in ARCHIVE_AGGREGATIONS)):
+            return self.history.get_ts_columns(key, start, end, points, aggregation, bucket)
+
+        # whole second buckets, so the database range can start on a bucket boundary
+        bucket = math.ceil(bucket_size(start, end, points, bucket) / 1000) * 1000
+        archive_aggregation = aggregation
+        if(aggregation is None and bucket > PERF_RAW_RESOLUTION):
+            archive_aggregation = PERF_COMPACTION_TYPE
+
+        split = min(math.ceil(live_start / bucket) * bucket if archive_aggregation else math.ceil(live_start / 1000) * 1000, end * 1000)
+        times, values = self.__read(key, start * 1000, split)
+        if(not times):
+            # nothing archived, the database may still have averaged values
+            return self.history.get_ts_columns(key, start, end, points, aggregation, bucket / 1000)
+
+        resolution = 0
+        if(archive_aggregation is not None):
+            times, values = self.__aggregate(times, values, bucket, ARCHIVE_AGGREGATIONS[archive_aggregation])
+            resolution = bucket / 1000
+
+        result = {"unix_times": array("d", [t / 1000 for t in times]), "values": values, "resolution": resolution}
+        if(split < end * 1000):
+            live = self.history.get_ts_columns(key, split // 1000, end, points, aggregation, bucket / 1000)
+            result = {"unix_times": result['unix_times'] + live['unix_times'], "values": result['values'] + live['values'],
+                      "resolution": max(resolution, live['resolution'])}
+
+        return result
+
+    def get_stats(self):
+        """
+        :returns: dict of the number of archive runs, segments and points written, series that couldn't be archived (errors),
+        and the seconds the last run took
+        """
+        return dict(self._stats)
+
+    def archive(self):
+        """ writes every day of each series that has ended and isn't archived yet """
+        start = time.time()
+        now = int(start * 1000)
+        last_day = (now - ARCHIVE_DELAY) // SEGMENT_DAY
+
+        for key in self.history.list_series():
+            days = self.__list_days(key)
+
+            # start at the day after the last archived day, or the oldest point still in the database
+            first = max(days) + 1 if days else 0
+            range_start = math.ceil(max(first * SEGMENT_DAY, now - PERF_RETENTION) / 1000)
+            if(range_start * 1000 >= last_day * SEGMENT_DAY):
+                continue
+
+            try:
+                # read the raw series directly, the end time is included so points in the last second of the range are found
+                columns = self.history.get_raw_ts_columns(key, range_start, int(last_day * SEGMENT_DAY / 1000))
+                times = array("q", [round(t * 1000) for t in columns['unix_times']])
+                values = columns['values']
+
+                i = 0
+                while(i < len(times) and times[i] < last_day * SEGMENT_DAY):
+                    day = times[i] // SEGMENT_DAY
+                    j = bisect.bisect_left(times, (day + 1) * SEGMENT_DAY, i)
+                    self.__write_day(key, day, times[i:j], values[i:j])
+                    self._stats['segments'] = self._stats['segments'] + 1
+                    self._stats['points'] = self._stats['points'] + j - i
+                    i = j
+            except Exception:
+                logging.exception(f"Error archiving performance data for {key}")
+                self._stats['errors'] = self._stats['errors'] + 1
+
+        self._stats['runs'] = self._stats['runs'] + 1
+        self._stats['last_run_time'] = time.time() - start
+
+    def __run(self):
+        while(True):
+            try:
+                self.archive()
+            except Exception:
+                logging.exception("Error archiving performance data")
+
+            time.sleep(ARCHIVE_INTERVAL)
+
+    def __series_path(self, key):
+        return os.path.join(self.path, urllib.parse.quote(key, safe=""))
+
+    def __day_path(self, key, day):
+        name = datetime.datetime.fromtimestamp(day * SEGMENT_DAY / 1000, datetime.timezone.utc).strftime("%Y%m%d")
+        return os.path.join(self.__series_path(key), name + SEGMENT_EXTENSION)
+
+    def __list_days(self, key):
+        """ :returns: set of the archived days of the series, as days since the epoch """
+        path = self.__series_path(key)
+        if(not os.path.isdir(path)):
+            return set()
+
+        result = set()
+        for name in os.listdir(path):
+            if(name.endswith(SEGMENT_EXTENSION)):
+                day = datetime.datetime.strptime(name[:-len(SEGMENT_EXTENSION)], "%Y%m%d").replace(tzinfo=datetime.timezone.utc)
+                result.add(int(day.timestamp() * 1000) // SEGMENT_DAY)
+
+        return result
+
+    def __write_day(self, key, day, times, values):
+        """ writes the points of one day to its segment file. The file is written under a temporary name first,
+        so a segment is either complete or missing """
+        deltas = array("q", [times[0]] + [b - a for a, b in zip(times, times[1:])])
+        values = array("d", values)
+        if(sys.byteorder != 'little'):
+            deltas.byteswap()
+            values.byteswap()
+
+        times_z = zlib.compress(deltas.tobytes())
+        values_z = zlib.compress(values.tobytes())
+
+        path = self.__day_path(key, day)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, len(times), len(times_z), len(values_z)))
+            f.write(times_z)
+            f.write(values_z)
+        os.replace(path + ".tmp", path)
+
+    def __read_day(self, path):
+        """ reads a segment file through a memory map
+
+        :returns: tuple of the millisecond times and values arrays
+        """
+        with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as segment, memoryview(segment) as view:
+            magic, count, times_size, values_size = SEGMENT_HEADER.unpack_from(view)
+            if(magic != SEGMENT_MAGIC):
+                raise ValueError(f"{path} is not a performance data segment")
+
+            offset = SEGMENT_HEADER.size
+            deltas = array("q", zlib.decompress(view[offset:offset + times_size]))
+            values = array("d", zlib.decompress(view[offset + times_size:offset + times_size + values_size]))
+
+        if(sys.byteorder != 'little'):
+            deltas.byteswap()
+            values.byteswap()
+
+        return array("q", itertools.accumulate(deltas)), values
+
+    def __read(self, key, start, end):
+        """ reads the archived points from the start time up to, not including, the end time, both in milliseconds
+
+        :returns: tuple of the millisecond times and values arrays
+        """
+        times = array("q")
+        values = array("d")
+
+        for day in sorted(d for d in self.__list_days(key) if start // SEGMENT_DAY <= d <= (end - 1) // SEGMENT_DAY):
+            day_times, day_values = self.__read_day(self.__day_path(key, day))
+            i = bisect.bisect_left(day_times, start)
+            j = bisect.bisect_left(day_times, end)
+            times.extend(day_times[i:j])
+            values.extend(day_values[i:j])
+
+        return times, values
+
+    def __aggregate(self, times, values, bucket, aggregate):
+        """ aggregates the points into buckets aligned to the epoch, like TS.RANGE. Each bucket is found with a binary search
+        so the values are only looped over by the aggregation
+
+        :returns: tuple of the bucket start times and aggregated values arrays
+        """
+        result_times = array("q")
+        result_values = array("d")
+
+        i = 0
+        while(i < len(times)):
+            bucket_start = times[i] - times[i] % bucket
+            j = bisect.bisect_left(times, bucket_start + bucket, i)
+            result_times.append(bucket_start)
+            result_values.append(aggregate(values[i:j]))
+            i = j
+
+        return result_times, result_values
@@ -0,0 +1,114 @@
+"""
+cache.py
+
+Read-through cache of host lookups for the web interface
+
+"""
+import json
+import logging
+import threading
+
+
+class HistoryCache:
+    """
+    Answers host lookups from memory, reading from the HostHistory database only on a miss. Service lookups are
+    answered by the ServiceIndex instead. Every save to the database publishes the ids of the hosts that changed.
+    Lookups of those hosts are dropped when the message is seen, along with the lookups that span every host.
+    Nothing is cached until the subscription starts, if it is lost everything is dropped and again once it is back.
+
+    Entries are held as JSON strings and parsed on every hit so callers can change what is returned.
+    """
+    max_entries = 1000
+    history = None
+    _entries = None
+    _version = 0
+    _listening = False
+    _lock = None
+    _stats = None
+
+    def __init__(self, history, max_entries=1000):
+        """
+        :param history: a HostHistory object to read from and subscribe to updates with
+        :param max_entries: the most lookups to keep, the oldest are dropped first
+        """
+        self.history = history
+        self.max_entries = max_entries
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+        threading.Thread(name='History Cache', target=self.__listen, daemon=True).start()
+
+    def list_hosts(self):
+        return self.__read('list_hosts')
+
+    def get_hosts(self):
+        return self.__read('get_hosts')
+
+    def get_host(self, host_id):
+        return self.__read('get_host', host_id, host_id=host_id)
+
+    def get_stats(self):
+        """
+        :returns: dict of the number of cache hits, misses, and invalidation messages, the number of entries, and if
+        the update subscription is active
+        """
+        with self._lock:
+            return dict(self._stats, entries=len(self._entries), listening=self._listening)
+
+    def clear(self):
+        """drops every cached lookup"""
+        with self._lock:
+            self._version = self._version + 1
+            self._entries.clear()
+
+    def __read(self, method, *args, host_id=None):
+        """
+        returns the cached result of the HostHistory method, calling it on a miss
+
+        :param method: the name of the HostHistory method
+        :param args: the method arguments
+        :param host_id: the single host the result depends on, None if it can change when any host is saved
+        """
+        key = json.dumps([method, args])
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if(entry is not None):
+                self._stats['hits'] = self._stats['hits'] + 1
+                return json.loads(entry[1])
+
+            self._stats['misses'] = self._stats['misses'] + 1
+            version = self._version
+
+        result = getattr(self.history, method)(*args)
+
+        with self._lock:
+            # don't keep the result if it may have changed while it was read
+            if(self._listening and version == self._version):
+                if(len(self._entries) >= self.max_entries):
+                    del self._entries[next(iter(self._entries))]
+                self._entries[key] = (host_id, json.dumps(result))
+
+        return result
+
+    def __invalidate(self, host_ids):
+        """drops lookups of these hosts and any that span all hosts"""
+        host_ids = set(host_ids)
+
+        with self._lock:
+            self._version = self._version + 1
+            self._stats['invalidations'] = self._stats['invalidations'] + 1
+
+            for key in [k for k, e in self._entries.items() if e[0] is None or e[0] in host_ids]:
+                del self._entries[key]
+
+    def __listen(self):
+        for host_ids in self.history.listen_updates():
+            if(host_ids is None):
+                # (re)subscribed, anything cached may be out of date
+                logging.debug("Host update subscription started, clearing the history cache")
+                self.clear()
+                self._listening = True
+            else:
+                self.__invalidate(host_ids)
@@ -1,5 +1,4 @@
-import modules.utils as utils
-from datetime import datetime
+import time
 from slugify import slugify
 from modules.exceptions import ConfigValueMissingError
 
@@ -19,6 +18,7 @@ class Device:
     interval = 5
     check_attempts = 3
     services = []
+    parents = []
     silenced = False
 
     def __init__(self, host_def):
@@ -36,8 +36,9 @@ class Device:
         self.services = host_def['services']
         self.last_check = 0
         self.next_check = 0
-        self.silenced = datetime.now().strftime(utils.TIME_FORMAT)
+        self.silenced = time.time()
         self.ping_command = None if 'ping_command' not in host_def else host_def['ping_command']
+        self.parents = host_def['parents'] if 'parents' in host_def else []
 
         # set the address as part of the config
         self.config['address'] = self.address
@@ -47,7 +48,7 @@ class Device:
         can be serialized for JSON output"""
         result = {'type': self.type, 'id': self.id, 'name': self.name, 'address': self.address,
                   'icon': self.icon, 'info': self.info, 'interval': self.interval, 'service_check_attempts': self.check_attempts,
-                  'last_check': self.last_check, 'config': self.config, 'silenced': self.is_silenced()}
+                  'last_check': self.last_check, 'config': self.config, 'silenced': self.is_silenced(), 'parents': self.parents}
 
         # set these values if they exist
         if(self.management_page is not None):
@@ -69,9 +70,7 @@ class Device:
         Returns true/false if the host should currently be in silent mode.
         This is true if the silenced timestamp is greater than the current time
         """
-        silence_off = datetime.strptime(self.silenced, utils.TIME_FORMAT)
-
-        return silence_off > datetime.now()
+        return self.silenced > time.time()
 
 
 class HostType:
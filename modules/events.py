@@ -0,0 +1,118 @@
+"""
+events.py
+
+Compares each round of host check results to the last known results and creates change events
+
+"""
+import logging
+import modules.utils as utils
+from collections import namedtuple
+from threading import Lock
+
+# event types
+HOST_UP = "host_up"
+HOST_DOWN = "host_down"
+SERVICE_CHANGED = "service_changed"  # a confirmed change in service status
+SERVICE_ADDED = "service_added"
+SERVICE_REMOVED = "service_removed"
+
+# service and old_service are None for host events, old_service is None when a service is added
+Event = namedtuple('Event', ['type', 'host', 'service', 'old_service'])
+
+
+class StateDiff:
+    """
+    Keeps the last known Alive and service states of each host, keyed by service id. Each round of check results is
+    diffed against these in one pass and the resulting events are sent to every listener. State is seeded once
+    from the database on startup and then kept in memory.
+
+    Nothing is known about a host that is unreachable because its parents are down, it has no events and its last
+    checked state is kept. Once it can be reached again it is diffed against that state, so a host that was up before
+    and after doesn't send an up event, and one that stayed down doesn't send a second down event.
+    """
+    _hosts = None
+    _listeners = None
+    _lock = None
+
+    def __init__(self):
+        self._hosts = {}
+        self._listeners = []
+        self._lock = Lock()
+
+    def load(self, services):
+        """
+        Loads the initial state of each host from its saved services
+
+        :param services: list of service dicts, as saved in the database
+        """
+        hosts = {}
+        for s in services:
+            hosts.setdefault(s['host']['id'], {})[s['id']] = self.__state(s)
+
+        with self._lock:
+            # an Alive check of Unknown (3) is only saved for unreachable hosts, their last checked state isn't known
+            self._hosts.update({host_id: states for host_id, states in hosts.items()
+                                if not any(s['name'] == 'Alive' and s['return_code'] == 3 for s in states.values())})
+
+    def add_listener(self, listener):
+        """
+        :param listener: function called with the list of events from each round of checks
+        """
+        self._listeners.append(listener)
+
+    def diff(self, hosts):
+        """
+        Finds what changed in this round of host checks and sends the events to the listeners
+
+        :param hosts: list of host check results
+
+        :returns: list of Event tuples
+        """
+        result = []
+
+        with self._lock:
+            for host in hosts:
+                result = result + self.__diff_host(host)
+
+        for listener in self._listeners:
+            try:
+                listener(result)
+            except Exception:
+                logging.exception(f"Error sending events to {listener}")
+
+        return result
+
+    def __state(self, service):
+        return {"name": service['name'], "return_code": service['return_code'], "state": service['state'], "service": service}
+
+    def __diff_host(self, host):
+        result = []
+
+        if(host.get('unreachable')):
+            # keep the last checked state until the host can be reached again
+            return result
+
+        new = {s['id']: self.__state(s) for s in host['services']}
+        old = self._hosts.get(host['id'])
+        self._hosts[host['id']] = new
+
+        # no events the first time a host is checked
+        if(old is None):
+            return result
+
+        old_alive = next((s['return_code'] for s in old.values() if s['name'] == 'Alive'), None)
+        if(old_alive is not None and old_alive != host['alive']):
+            # the host status covers everything else
+            result.append(Event(HOST_UP if host['alive'] == 0 else HOST_DOWN, host, None, None))
+        else:
+            for service_id, s in new.items():
+                if(service_id not in old):
+                    result.append(Event(SERVICE_ADDED, host, s['service'], None))
+                elif((s['return_code'] != old[service_id]['return_code'] and s['state'] == utils.CONFIRMED_STATE) or
+                     (old[service_id]['state'] == utils.UNCONFIRMED_STATE and s['state'] == utils.CONFIRMED_STATE)):
+                    result.append(Event(SERVICE_CHANGED, host, s['service'], old[service_id]['service']))
+
+            for service_id in old.keys() - new.keys():
+                result.append(Event(SERVICE_REMOVED, host, old[service_id]['service'], old[service_id]['service']))
+
+        return result
@@ -14,3 +14,9 @@ class ConfigValueMissingError(Exception):
     """Exception thrown when a configuration value is listed as required for a device type but missing from the host config"""
     def __init__(self, device_name, config_value, type):
         super().__init__(f"A config value ({config_value}) for device {device_name} is missing but required for device type {type}")
+
+
+class HostParentError(Exception):
+    """Exception thrown when a host lists a parent that isn't defined, or host parents form a loop"""
+    def __init__(self, host_id, message):
+        super().__init__(f"Invalid parents for host {host_id}: {message}")
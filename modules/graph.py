@@ -0,0 +1,66 @@
+"""
+graph.py
+
+Tracks the parent hosts each host depends on, such as the switch or router it is connected through
+
+"""
+from modules.exceptions import HostParentError
+
+
+class HostGraph:
+    """
+    A directed acyclic graph of hosts and their parents. Each host has a depth, hosts without parents
+    are at depth 0 and every other host is one deeper than its deepest parent. Checking hosts in order
+    of depth means every parent has been checked before its children.
+    """
+    _parents = None
+    _depth = None
+
+    def __init__(self, parents):
+        """
+        :param parents: dict of host id to the list of parent host ids
+
+        :raises HostParentError: if a parent isn't a known host or the parents form a loop
+        """
+        self._parents = parents
+        self._depth = {}
+
+        for host_id in parents:
+            self.__find_depth(host_id, [])
+
+    def get_parents(self, host_id):
+        """:returns: list of the parent host ids"""
+        return self._parents.get(host_id, [])
+
+    def get_depth(self, host_id):
+        return self._depth.get(host_id, 0)
+
+    def levels(self, host_ids):
+        """
+        Groups hosts by their depth
+
+        :param host_ids: list of host ids
+
+        :returns: list of lists of host ids, the hosts without parents first
+        """
+        result = {}
+        for host_id in host_ids:
+            result.setdefault(self.get_depth(host_id), []).append(host_id)
+
+        return [result[depth] for depth in sorted(result)]
+
+    def __find_depth(self, host_id, path):
+        if(host_id not in self._depth):
+            if(host_id in path):
+                raise HostParentError(host_id, f"parents form a loop ({' -> '.join(path + [host_id])})")
+
+            depth = 0
+            for parent in self._parents[host_id]:
+                if(parent not in self._parents):
+                    raise HostParentError(host_id, f"parent {parent} is not a defined host")
+
+                depth = max(depth, self.__find_depth(parent, path + [host_id]) + 1)
+
+            self._depth[host_id] = depth
+
+        return self._depth[host_id]
@@ -1,13 +1,261 @@
 import datetime
+import itertools
 import json
+import logging
+import math
+import operator
+import re
 import redis
+import time
+import modules.utils as utils
+from abc import ABC, abstractmethod
+from array import array
 from enum import Enum
 
+# perf data series are saved for 30 days
+PERF_RETENTION = 86400000 * 30
 
-class HostHistory:
+# each perf data series is averaged into these buckets as (bucket size, retention), both in milliseconds
+# 5 minute averages are saved for 6 months and hourly averages for 2 years
+PERF_COMPACTIONS = [(300000, 86400000 * 180), (3600000, 86400000 * 730)]
+PERF_COMPACTION_TYPE = "avg"
+
+# checks run at most once a minute, used as the resolution of the raw series
+PERF_RAW_RESOLUTION = 60000
+
+# the default number of points returned for a time range
+PERF_POINTS = 1000
+
+# seconds to wait before subscribing to host updates again after losing the connection
+UPDATE_RETRY = 5
+
+# aggregation types supported by TS.RANGE
+TS_AGGREGATIONS = ["avg", "sum", "min", "max", "range", "count", "first", "last", "std.p", "std.s", "var.p", "var.s", "twa"]
+
+# a check saved twice with the same timestamp replaces the earlier point
+PERF_DUPLICATE_POLICY = "last"
+
+# lowercase parts of the TimeSeries error messages handled when saving perf data
+PERF_DUPLICATE_ERROR = "duplicate_policy"
+PERF_MISSING_ERROR = "key does not exist"
+PERF_EXISTS_ERROR = "already"
+
+
+def ts_data(columns):
+    """ converts time series columns to lists, adding the formatted times
+
+    :param columns: dict in the HostHistory.get_ts_columns() format
+
+    :returns: dict of the times and values in the range and the resolution of each point, in seconds (0 for raw points)
+    """
+    result = {"unix_times": columns['unix_times'].tolist(), "values": columns['values'].tolist(), "resolution": columns['resolution']}
+    result['times'] = [datetime.datetime.fromtimestamp(t).strftime("%m/%d/%y %H:%M:%S") for t in result['unix_times']]
+
+    return result
+
+
+def bucket_size(start, end, points, bucket=None):
+    """ the aggregation bucket size of a time series range, see HostHistory.get_ts_columns()
+
+    :param start: the start of the range, as a unix timestamp
+    :param end: the end of the range, as a unix timestamp
+    :param points: the most points to fit in the range when no bucket is given
+    :param bucket: the bucket size in seconds, if set
+
+    :returns: the bucket size in milliseconds
+    """
+    return int(bucket * 1000) if bucket else max(math.ceil((end - start) * 1000 / max(points, 1)), 1)
+
+
+class HostHistory(ABC):
+    """
+    Abstract class for saving the status of each host and the perf data of its services. Implementing classes
+    store these in a database. Hosts are saved as dicts, including a list of their services. Perf data points
+    are saved to a time series for each perf data id.
+    """
+
+    # aggregation types that can be passed to get_ts_data()
+    aggregations = []
+
+    @abstractmethod
+    def save_last_check(self):
+        """sets the last check time using the current time as a unix timestamp"""
+        pass
+
+    @abstractmethod
+    def get_last_check(self):
+        """returns the last check time saved in the DB
+
+        :returns: the last update time as a datetime object
+        """
+        pass
+
+    @abstractmethod
+    def list_hosts(self):
+        """ :returns: the sorted ids of all saved hosts """
+        pass
+
+    @abstractmethod
+    def get_hosts(self):
+        """ returns all host information from the database, without the services """
+        pass
+
+    @abstractmethod
+    def get_host(self, host_id):
+        """ get host information from the database based on the ID
+
+        :param host_id: a valid host
+
+        :returns: a dict with the host information, empty if not found
+        """
+        pass
+
+    @abstractmethod
+    def get_tag(self, tag_id):
+        """ finds services matching the given tag id
+
+        :param tag_id: the id of the tag to lookup
+
+        :returns: dict of the tag id and the list of services that include this tag
+        """
+        pass
+
+    @abstractmethod
+    def get_services(self, return_codes=[0], service_filter=".*"):
+        """ returns a list of services where the status is one of the the given return_codes
+        AND the id matches the given service filter
+
+        :param return_codes: list of return codes to find as an array
+        :param service_filter: service_id syntax to match - this is a regular expression
+
+        :returns: list of services that meet these criteria, sorted by id
+        """
+        pass
+
+    @abstractmethod
+    def get_service(self, service_id):
+        """ get information on a specific service from a specific host
+
+        :param service_id: a valid service id
+
+        :returns: a dict with the service information, empty if not found
+        """
+        pass
+
+    def get_ts_data(self, key, start, end, points=PERF_POINTS, aggregation=None, bucket=None):
+        """ gets the values of a perf data series within a time range along with formatted times, see get_ts_columns()
+
+        :returns: dict of the times and values in the range and the resolution of each point, in seconds (0 for raw points)
+        """
+        return ts_data(self.get_ts_columns(key, start, end, points, aggregation, bucket))
+
+    @abstractmethod
+    def get_ts_columns(self, key, start, end, points=PERF_POINTS, aggregation=None, bucket=None):
+        """ gets the values of a perf data series within a time range. When there would be more than the
+        requested number of points they are averaged into larger buckets
+
+        :param key: the perf data id
+        :param start: unix timestamp of the start of the range
+        :param end: unix timestamp of the end of the range
+        :param points: the most points to return
+        :param aggregation: one of the aggregations, to aggregate the saved values into buckets
+        :param bucket: the aggregation bucket size in seconds, worked out from the points when not given
+
+        :returns: dict of the unix times and values in the range as float arrays, and the resolution of each point in seconds (0 for raw points)
+        """
+        pass
+
+    @abstractmethod
+    def get_raw_ts_columns(self, key, start, end):
+        """ gets every raw point of a perf data series within a time range, without picking an averaged series or
+        aggregating the values. Points older than the raw retention have already been removed
+
+        :param key: the perf data id
+        :param start: unix timestamp of the start of the range
+        :param end: unix timestamp of the end of the range, included
+
+        :returns: dict in the get_ts_columns() format, with a resolution of 0
+        """
+        pass
+
+    @abstractmethod
+    def list_series(self):
+        """ :returns: the sorted ids of all saved perf data series """
+        pass
+
+    @abstractmethod
+    def set_hosts(self, host_ids):
+        """ takes a list of host names and compares against the DB,
+        ids that do not exist are deleted - should be run at on startup
+
+        :param host_ids: list of host ids from the config
+        """
+        pass
+
+    @abstractmethod
+    def listen_updates(self):
+        """ waits for hosts to be saved or deleted. This is a generator that never ends, it should be read from its own thread
+
+        :returns: the list of host ids from each save, None when updates may have been missed and anything read before is out of date
+        """
+        pass
+
+    def migrate_hosts(self):
+        """ moves hosts saved by older versions to the current layout, nothing to do unless the database was used by older versions
+        should be run on startup, before any hosts are loaded
+        """
+        pass
+
+    def migrate_timestamps(self):
+        """ converts host and service times saved as formatted strings by older versions to unix timestamps,
+        nothing to do unless the database was used by older versions. Should be run on startup, before any hosts are loaded
+        """
+        pass
+
+    def save_host(self, host_id, host_status, update_perf_data=True):
+        """ saves the host status to the database with the given ID, see save_hosts()
+
+        :param host_id: a valid host id
+        :param host_status: the host's status as a dict
+        """
+        self.save_hosts([host_status], update_perf_data)
+
+    @abstractmethod
+    def save_hosts(self, batch, update_perf_data=True):
+        """ saves a batch of host statuses, such as all the hosts checked in one cycle
+
+        :param batch: list of host status dicts
+        :param update_perf_data: if the perf data for each service should be added to its time series
+        """
+        pass
+
+    @abstractmethod
+    def save_perf_data(self, batch):
+        """ adds the perf data of each host status to its time series, without saving the statuses. Used for results
+        that were replaced by a newer status before they could be saved
+
+        :param batch: list of host status dicts
+        """
+        pass
+
+    def _to_columns(self, ts_data, resolution):
+        """ splits (millisecond time, value) pairs into columns, without a Python loop over each point
+
+        :returns: dict in the get_ts_columns() format
+        """
+        times, values = zip(*ts_data) if ts_data else ((), ())
+
+        return {"unix_times": array("d", map(operator.truediv, times, itertools.repeat(1000))), "values": array("d", values),
+                "resolution": resolution / 1000}
+
+
+class RedisHistory(HostHistory):
     """ Encapulates reading/writing to the Redis database"""
 
+    aggregations = TS_AGGREGATIONS
+
     db = None
+    _series = None  # keys of known time series, found on the first save
 
     def __init__(self, db_host):
         self.db = redis.Redis(db_host, decode_responses=True)
@@ -28,11 +276,11 @@ class HostHistory:
         return last_update
 
     def list_hosts(self):
-        return self.__read_db_json(DBQueries.GET_HOST_IDS.value)
+        return sorted(self.db.smembers(DBKeys.HOST_IDS.value))
 
     def get_hosts(self):
         """ returns all host information from the database """
-        all_hosts = self.__read_db_json("$[*]")
+        all_hosts = self.__read_hosts(self.list_hosts())
 
         for i in range(0, len(all_hosts)):
             all_hosts[i].pop("services")
@@ -46,12 +294,9 @@ class HostHistory:
 
         :returns: a dict with the host information, empty if not found
         """
-        host = self.__read_db_json(DBQueries.GET_HOST.value.format(host_id=host_id))
-
-        if(not host):
-            host = [{}]
+        host = self.db.json().get(DBKeys.HOST.value.format(host_id=host_id))
 
-        return host[0]
+        return host if host is not None else {}
 
     def get_tag(self, tag_id):
         """ finds services matching the given tag id
@@ -63,7 +308,7 @@ class HostHistory:
 
         # get list of services matching this tag id
         result = {"id": tag_id}
-        result['services'] = self.__read_db_json(DBQueries.GET_TAG.value.format(tag_id=tag_id))
+        result['services'] = self.__read_services(self.db.smembers(DBKeys.TAG.value.format(tag_id=tag_id)))
 
         return result
 
@@ -76,11 +321,11 @@ class HostHistory:
 
         :returns: list of services that meet these criteria
         """
+        service_ids = self.db.sunion([DBKeys.RETURN_CODE.value.format(return_code=r) for r in return_codes]) if return_codes else []
 
-        # turn the list into a JPath query ()
-        query = " || ".join([f"@.return_code == {r}" for r in return_codes])
-
-        return self.__read_db_json(DBQueries.GET_SERVICES_BY_QUERY.value.format(return_codes=query, service_regex=service_filter))
+        # filter the ids before loading the services
+        pattern = re.compile(service_filter)
+        return self.__read_services([s for s in service_ids if pattern.search(s)])
 
     def get_service(self, service_id):
         """ get information on a specific service from a specific host
@@ -89,25 +334,59 @@ class HostHistory:
 
         :returns: a dict with the service information, empty if not found
         """
-        service = self.__read_db_json(DBQueries.GET_SERVICE.value.format(service_id=service_id))
+        service = self.__read_services([service_id])
 
-        if(not service):
-            service = [{}]
+        return service[0] if service else {}
 
-        return service[0]
+    def get_ts_columns(self, key, start, end, points=PERF_POINTS, aggregation=None, bucket=None):
+        """ gets the values of a perf data series within a time range. Long ranges are read from the averaged
+        series instead of the raw series, the coarsest one that still gives the requested number of points.
+        If there are still too many points they are averaged again by Redis into larger buckets
 
-    def get_ts_data(self, key, start, end):
-        result = {"times": [], "values": [], 'unix_times': []}
+        :param key: the perf data id
+        :param start: unix timestamp of the start of the range
+        :param end: unix timestamp of the end of the range
+        :param points: the most points to return
+        :param aggregation: a TS.RANGE aggregation type, to aggregate the raw series directly. The averaged
+        series are used if the start of the range is older than the raw series retention
+        :param bucket: the aggregation bucket size in seconds, worked out from the points when not given
 
-        # turn seconds into milliseconds
-        ts_data = self.db.ts().range(key, start * 1000, end * 1000)
-
-        for d in ts_data:
-            result['unix_times'].append(d[0] / 1000)
-            result['times'].append(datetime.datetime.fromtimestamp(d[0] / 1000).strftime("%m/%d/%y %H:%M:%S"))
-            result['values'].append(d[1])
+        :returns: dict of the unix times and values in the range as float arrays, and the resolution of each point in seconds (0 for raw points)
+        """
+        bucket = bucket_size(start, end, points, bucket)
 
-        return result
+        # turn seconds into milliseconds
+        start = start * 1000
+        end = end * 1000
+
+        # aggregate the raw series when an aggregation is given, the averaged series can't give the real min, max, etc
+        series, resolution = self.__pick_series(key, start, 0 if aggregation else bucket)
+        try:
+            ts_data, resolution = self.__read_range(series, resolution, start, end, aggregation, bucket)
+        except redis.ResponseError as e:
+            if(series == key or PERF_MISSING_ERROR not in str(e).lower()):
+                raise
+
+            # series from older versions have no averaged series until the first save after upgrading
+            logging.debug(f"{series} does not exist, reading {key} instead")
+            ts_data, resolution = self.__read_range(key, 0, start, end, aggregation, bucket)
+
+        return self._to_columns(ts_data, resolution)
+
+    def get_raw_ts_columns(self, key, start, end):
+        """ gets every point of the raw series within a time range, see HostHistory.get_raw_ts_columns() """
+        try:
+            ts_data = self.db.ts().range(key, start * 1000, end * 1000)
+        except redis.ResponseError as e:
+            if(PERF_MISSING_ERROR not in str(e).lower()):
+                raise
+            ts_data = []
+
+        return self._to_columns(ts_data, 0)
+
+    def list_series(self):
+        # the known series are found on the first save, scan for them until then
+        return sorted(self._series if self._series is not None else self.__scan_series())
 
     def set_hosts(self, host_ids):
         """ takes a list of host names and compares against the DB,
@@ -115,62 +394,309 @@ class HostHistory:
 
         :param host_ids: list of host ids from the config
         """
-        # get a list of all hosts in DB
-        all_hosts = self.list_hosts()
+        # get items that are not in current list
+        old_hosts = list(set(self.list_hosts()) - set(host_ids))
 
-        if(all_hosts is None):
-            # probably the first run
-            self.__write_db_json("$", [])
-        else:
-            # get items that are not in current list
-            old_hosts = list(set(all_hosts) - set(host_ids))
+        # delete the old hosts
+        for host_id in old_hosts:
+            def delete_host(pipe):
+                old_services = self.__read_host_services(pipe, host_id)
 
-            # delete the old hosts
-            for host_id in old_hosts:
-                self.db.json().delete(DBKeys.HOST_KEY.value, DBQueries.GET_HOST.value.format(host_id=host_id))
+                pipe.multi()
+                self.__remove_indexes(pipe, old_services)
+                pipe.delete(DBKeys.HOST.value.format(host_id=host_id))
+                pipe.srem(DBKeys.HOST_IDS.value, host_id)
+                self.__publish_update(pipe, [host_id])
 
-    def save_host(self, host_id, host_status, update_perf_data=True):
-        """ saves the host status to the database with the given ID
+            self.db.transaction(delete_host, DBKeys.HOST.value.format(host_id=host_id))
 
-        :param host_id: a valid host id
-        :param host_status: the host's status as a dict
+    def listen_updates(self):
+        """ waits for hosts to be saved or deleted by any process using this database. This is a generator that
+        never ends, it should be read from its own thread
+
+        :returns: the list of host ids from each save, None when updates may have been missed and anything read before is out of date
         """
+        while(True):
+            pubsub = self.db.pubsub()
+            try:
+                pubsub.subscribe(DBKeys.UPDATES.value)
+
+                for message in pubsub.listen():
+                    if(message['type'] == 'subscribe'):
+                        # also sent again after reconnecting
+                        yield None
+                    elif(message['type'] == 'message'):
+                        yield json.loads(message['data'])
+            except redis.ConnectionError as e:
+                logging.warning(f"Lost the host update subscription, trying again: {e}")
+                pubsub.close()
+                yield None
+                time.sleep(UPDATE_RETRY)
+
+    def migrate_hosts(self):
+        """ moves hosts saved by older versions as one JSON array under the hosts key to their own keys
+        should be run on startup, before any hosts are loaded
+        """
+        if(self.__exists(DBKeys.LEGACY_HOSTS.value)):
+            all_hosts = self.db.json().get(DBKeys.LEGACY_HOSTS.value, "$[*]")
+            logging.info(f"Moving {len(all_hosts)} saved hosts to per host keys")
+
+            for host in all_hosts:
+                self.save_host(host['id'], host, update_perf_data=False)
+
+            self.db.delete(DBKeys.LEGACY_HOSTS.value)
+
+    def migrate_timestamps(self):
+        """ converts host and service times saved as formatted strings by older versions to unix timestamps
+        should be run on startup, before any hosts are loaded
+        """
+        all_hosts = self.__read_hosts(self.list_hosts())
 
-        # delete the old value
-        self.db.json().delete(DBKeys.HOST_KEY.value, DBQueries.GET_HOST.value.format(host_id=host_id))
+        for host in all_hosts:
+            if(isinstance(host.get('last_check'), str) or isinstance(host.get('next_check'), str)):
+                logging.info(f"Converting saved times for {host['id']} to timestamps")
 
-        # add the new value https://redis.io/docs/latest/commands/json.arrappend/
-        self.db.json().arrappend(DBKeys.HOST_KEY.value, "$", host_status)
+                host['last_check'] = utils.parse_timestamp(host.get('last_check', 0))
+                host['next_check'] = utils.parse_timestamp(host.get('next_check', 0))
+                for s in host.get('services', []):
+                    s['last_state_change'] = utils.parse_timestamp(s['last_state_change'])
+
+                self.save_host(host['id'], host, update_perf_data=False)
+
+    def save_hosts(self, batch, update_perf_data=True):
+        """ saves a batch of host statuses, such as all the hosts checked in one cycle. Each host is saved under
+        its own key and the service indexes are updated to match. All the hosts are written in one transaction
+        and all the perf data points in one more pipeline, so the number of round trips doesn't grow with the batch.
+        Known time series are held in memory, so each data point is a single write
+
+        :param batch: list of host status dicts
+        :param update_perf_data: if the perf data for each service should be added to its time series
+        """
+        if(not batch):
+            return
+
+        host_keys = [DBKeys.HOST.value.format(host_id=h['id']) for h in batch]
+
+        with self.db.pipeline() as pipe:
+            while(True):
+                try:
+                    # the hosts are watched so the indexes can't be changed by another save in between
+                    pipe.watch(*host_keys)
+
+                    # read the old services of every host in one round trip
+                    reads = self.db.pipeline(transaction=False)
+                    for key in host_keys:
+                        reads.json().get(key, DBQueries.GET_SERVICES.value)
+                    results = reads.execute()
+
+                    # replace the hosts and their index entries in one transaction
+                    pipe.multi()
+                    for host_status, old_services in zip(batch, results):
+                        self.__replace_host(pipe, host_status, old_services or [])
+                    self.__publish_update(pipe, [h['id'] for h in batch])
+                    pipe.execute()
+                    break
+                except redis.WatchError:
+                    logging.debug("Hosts changed while saving, trying again")
 
         if(update_perf_data):
-            # save perf data
-            for s in host_status['services']:
-                unix_time = int(datetime.datetime.timestamp(datetime.datetime.strptime(host_status['last_check'], "%m-%d-%Y %I:%M%p")))
+            self.save_perf_data(batch)
 
-                # make sure perf data exists
-                if('perf_data' in s):
-                    for p in s['perf_data']:
-                        if(not self.__exists(p['id'])):
-                            # save for 30 days
-                            self.db.ts().create(p['id'], retention_msecs=(86400000 * 30))
+    def save_perf_data(self, batch):
+        """ adds the perf data of each host status to its time series, in one pipeline
 
-                        # add the value
-                        self.db.ts().add(p['id'], unix_time * 1000, p['value'])
+        :param batch: list of host status dicts
+        """
+        # time series use millisecond timestamps
+        perf_data = [(p['id'], int(h['last_check'] * 1000), p['value']) for h in batch for s in h['services'] for p in s.get('perf_data', [])]
+        self.__save_perf_data(perf_data)
+
+    def __save_perf_data(self, perf_data):
+        """ adds the data points to their time series in one pipeline. Points for known series are added with TS.MADD,
+        series that aren't known yet are created along with their averaged series before the first write """
+        if(not perf_data):
+            return
+
+        if(self._series is None):
+            self._series = self.__scan_series()
+
+        known = [p for p in perf_data if p[0] in self._series]
+        created = [p for p in perf_data if p[0] not in self._series]
+
+        pipe = self.db.pipeline(transaction=False)
+        for key in sorted({p[0] for p in created}):
+            self.__create_series(pipe, key)
+        setup = len(pipe)
+
+        for key, timestamp, value in created:
+            pipe.ts().add(key, timestamp, value)
+        if(known):
+            pipe.ts().madd(known)
+
+        results = pipe.execute(raise_on_error=False)
+        self.__log_create_errors(results[:setup])
+
+        results = results[setup:]
+        if(known):
+            # one result for each point added by TS.MADD, unless the whole command failed
+            madd = results.pop()
+            results = results + (madd if isinstance(madd, list) else [madd] * len(known))
+
+        for (key, timestamp, value), r in zip(created + known, results):
+            if(not isinstance(r, redis.ResponseError)):
+                self._series.add(key)
+            elif(PERF_DUPLICATE_ERROR in str(r).lower()):
+                # series created by older versions block duplicates, the point is already saved
+                logging.debug(f"Skipping duplicate performance data for {key} at {timestamp}")
+                self._series.add(key)
+            elif(PERF_MISSING_ERROR in str(r).lower()):
+                # deleted outside of this program, it will be created again on the next write
+                logging.warning(f"Performance data series {key} no longer exists, point at {timestamp} was not saved")
+                self._series.discard(key)
+            else:
+                logging.warning(f"Error saving performance data for {key}: {r}")
+
+    def __create_series(self, pipe, key):
+        """ adds commands to the pipeline to create the series and the series it is averaged into """
+        pipe.ts().create(key, retention_msecs=PERF_RETENTION, duplicate_policy=PERF_DUPLICATE_POLICY)
+
+        for bucket, retention in PERF_COMPACTIONS:
+            compaction = self.__compaction_key(key, bucket)
+            pipe.ts().create(compaction, retention_msecs=retention, duplicate_policy=PERF_DUPLICATE_POLICY)
+            pipe.ts().createrule(key, compaction, PERF_COMPACTION_TYPE, bucket)
+
+    def __compaction_key(self, key, bucket):
+        return DBKeys.TS_COMPACTION.value.format(series_id=key, aggregation=PERF_COMPACTION_TYPE, bucket=bucket)
+
+    def __pick_series(self, key, start, bucket):
+        """ finds the coarsest series with a resolution of at most the bucket size, that still holds the start time
+
+        :returns: tuple of the series key and its resolution in milliseconds, 0 for the raw series
+        """
+        now = time.time() * 1000
+        levels = [(key, 0, PERF_RETENTION)] + [(self.__compaction_key(key, b), b, r) for b, r in PERF_COMPACTIONS]
 
-    def __exists(self, key):
-        return self.db.exists(key) > 0
+        # fall back to the longest retention if none reach back far enough
+        levels = [level for level in levels if start >= now - level[2]] or levels[-1:]
+        result = levels[0]
+        for level in levels:
+            if(level[1] <= bucket):
+                result = level
 
-    def __read_db_json(self, query):
-        """ read a value from the DB using the JSON Module - https://redis.io/docs/latest/commands/json.get/
-        queries can be done as supported with JSON Paths - https://redis.io/docs/latest/develop/data-types/json/path/
+        return result[:2]
+
+    def __read_range(self, series, resolution, start, end, aggregation, bucket):
+        """ reads the range from the series, aggregated into buckets when there would be more points than wanted
+
+        :returns: tuple of the data points and their resolution in milliseconds, 0 for raw points
         """
-        result = self.db.json().get(DBKeys.HOST_KEY.value, query)
+        if(aggregation is None and bucket > max(resolution, PERF_RAW_RESOLUTION)):
+            aggregation = PERF_COMPACTION_TYPE
+
+        if(aggregation is None):
+            return self.db.ts().range(series, start, end), resolution
+
+        bucket = max(bucket, resolution)
+        return self.db.ts().range(series, start, end, aggregation_type=aggregation, bucket_size_msec=bucket), bucket
+
+    def __scan_series(self):
+        """ finds the keys of all existing time series. Series from older versions are given averaged series first """
+        keys = set(self.db.scan_iter(_type=DBKeys.TS_TYPE.value, count=1000))
+        compaction = re.compile(re.escape(self.__compaction_key("", "")) + r"\d+$")
+
+        result = {k for k in keys if all(self.__compaction_key(k, b) in keys for b, _ in PERF_COMPACTIONS)}
+        missing = sorted(k for k in keys - result if not compaction.search(k))
+        if(missing):
+            self.__add_compactions(missing)
+
+        return result.union(missing)
+
+    def __add_compactions(self, keys):
+        """ creates the averaged series of existing time series and fills them from the raw series """
+        logging.info(f"Adding averaged series to {len(keys)} performance data series")
+        pipe = self.db.pipeline(transaction=False)
+
+        for key in keys:
+            self.__create_series(pipe, key)
+        setup = len(pipe)
+
+        for key in keys:
+            for bucket, _ in PERF_COMPACTIONS:
+                pipe.ts().range(key, "-", "+", aggregation_type=PERF_COMPACTION_TYPE, bucket_size_msec=bucket)
+        results = pipe.execute(raise_on_error=False)
+        self.__log_create_errors(results[:setup])
+
+        fill = self.db.pipeline(transaction=False)
+        for (key, (bucket, _)), data in zip([(k, c) for k in keys for c in PERF_COMPACTIONS], results[setup:]):
+            if(data and not isinstance(data, redis.ResponseError)):
+                fill.ts().madd([(self.__compaction_key(key, bucket), t, v) for t, v in data])
+        fill.execute(raise_on_error=False)
+
+    def __log_create_errors(self, results):
+        """ logs the errors from creating series, series and rules that already exist are left as they are """
+        for r in results:
+            if(isinstance(r, redis.ResponseError) and PERF_EXISTS_ERROR not in str(r).lower()):
+                logging.warning(f"Error creating performance data series: {r}")
+
+    def __publish_update(self, pipe, host_ids):
+        """ adds a message to the pipeline telling anything listening which hosts changed """
+        pipe.publish(DBKeys.UPDATES.value, json.dumps(host_ids))
+
+    def __replace_host(self, pipe, host_status, old_services):
+        """ adds commands to the pipeline to save the host and swap its old index entries for the new ones """
+        self.__remove_indexes(pipe, old_services)
+        pipe.json().set(DBKeys.HOST.value.format(host_id=host_status['id']), "$", host_status)
+        pipe.sadd(DBKeys.HOST_IDS.value, host_status['id'])
+
+        for s in host_status['services']:
+            pipe.hset(DBKeys.SERVICE_HOSTS.value, s['id'], host_status['id'])
+            pipe.sadd(DBKeys.RETURN_CODE.value.format(return_code=s['return_code']), s['id'])
+            for tag in s.get('tags', []):
+                pipe.sadd(DBKeys.TAG.value.format(tag_id=tag), s['id'])
+
+    def __read_host_services(self, pipe, host_id):
+        """ the saved services on this host, used to clean up the indexes """
+        result = pipe.json().get(DBKeys.HOST.value.format(host_id=host_id), DBQueries.GET_SERVICES.value)
+
+        return result if result is not None else []
+
+    def __remove_indexes(self, pipe, services):
+        """ adds commands to the pipeline to remove these services from the indexes """
+        for s in services:
+            pipe.hdel(DBKeys.SERVICE_HOSTS.value, s['id'])
+            pipe.srem(DBKeys.RETURN_CODE.value.format(return_code=s['return_code']), s['id'])
+            for tag in s.get('tags', []):
+                pipe.srem(DBKeys.TAG.value.format(tag_id=tag), s['id'])
+
+    def __read_hosts(self, host_ids):
+        """ reads each of the given hosts in one round trip, skipping any that don't exist """
+        pipe = self.db.pipeline(transaction=False)
+        for host_id in host_ids:
+            pipe.json().get(DBKeys.HOST.value.format(host_id=host_id))
+
+        return [h for h in pipe.execute() if h is not None] if host_ids else []
+
+    def __read_services(self, service_ids):
+        """ looks up the host of each service in the index and reads only those services """
+        service_ids = sorted(service_ids)
+        result = []
+
+        if(service_ids):
+            host_ids = self.db.hmget(DBKeys.SERVICE_HOSTS.value, service_ids)
+
+            pipe = self.db.pipeline(transaction=False)
+            for service_id, host_id in zip(service_ids, host_ids):
+                if(host_id is not None):
+                    pipe.json().get(DBKeys.HOST.value.format(host_id=host_id), DBQueries.GET_SERVICE.value.format(service_id=service_id))
+
+            for service in pipe.execute():
+                if(service):
+                    result.append(service[0])
 
         return result
 
-    def __write_db_json(self, db_filter, db_value):
-        """ write an object to the DB using the JSON module"""
-        self.db.json().set(DBKeys.HOST_KEY.value, db_filter, db_value)
+    def __exists(self, key):
+        return self.db.exists(key) > 0
 
     def __read_db(self, db_key):
         """ read a value from the Redis DB based on the given key
@@ -190,15 +716,19 @@ class HostHistory:
 
 class DBKeys(Enum):
     """Enum that holds the keys for Redis data lookups"""
-    HOST_KEY = 'hosts'
+    HOST = 'host:{host_id}'  # JSON document for each host
+    HOST_IDS = 'host_ids'  # set of all host ids
+    SERVICE_HOSTS = 'service_hosts'  # hash of service id to host id
+    TAG = 'tag:{tag_id}'  # set of service ids with this tag
+    RETURN_CODE = 'return_code:{return_code}'  # set of service ids with this return code
+    LEGACY_HOSTS = 'hosts'  # all hosts as one JSON array, used by older versions
     LAST_CHECK = "last_check_timestamp"
+    UPDATES = "host_updates"  # pub/sub channel, sent the list of host ids after each save
+    TS_TYPE = "TSDB-TYPE"  # key type of a time series, used when scanning keys
+    TS_COMPACTION = '{series_id}:{aggregation}:{bucket}'  # series averaged into buckets of this many milliseconds
 
 
 class DBQueries(Enum):
-    """Enum that holds keys for JSON Queries"""
-    GET_HOST_IDS = '$[*].id'
-    GET_TAG_IDS = '$[*].services[*].tags'
-    GET_HOST = '$[?(@.id=="{host_id}")]'
-    GET_SERVICE = '$[*].services[?(@.id=="{service_id}")]'
-    GET_TAG = '$[*].services[?(@.tags[*]=="{tag_id}")]'
-    GET_SERVICES_BY_QUERY = '$[*].services[?(({return_codes}) && @.id=~"{service_regex}")]'
+    """Enum that holds keys for JSON Queries, within a single host document"""
+    GET_SERVICE = '$.services[?(@.id=="{service_id}")]'
+    GET_SERVICES = '.services'  # legacy path syntax, returns the value instead of a list of matches
@@ -0,0 +1,211 @@
+"""
+icmp.py
+
+Pings many hosts at once using ICMP echo requests sent from a single socket
+
+"""
+import itertools
+import logging
+import os
+import select
+import socket
+import struct
+import time
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+# type, code, checksum, identifier, sequence
+ICMP_HEADER = struct.Struct("!BBHHH")
+PAYLOAD = b"trash-panda-ping"
+
+
+def checksum(data):
+    """internet checksum (RFC 1071) of the given bytes"""
+    if(len(data) % 2):
+        data = data + b"\x00"
+
+    total = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total = total + (total >> 16)
+
+    return ~total & 0xFFFF
+
+
+class PingSweep:
+    """
+    Sends echo requests to a group of hosts in one sweep. Requests are interleaved across all the hosts
+    and replies are read from one shared receive loop. Each host is sent up to count requests, a host is
+    up if more than half are answered. Hosts stop getting requests once their outcome can't change.
+    """
+    count = 5
+    timeout = 2
+    interval = 0.2
+    _identifier = None
+    _sequence = None
+
+    def __init__(self, count=5, timeout=2, interval=0.2):
+        """
+        :param count: the number of echo requests to send each host
+        :param timeout: how long to wait for each reply, in seconds
+        :param interval: time between each round of requests, in seconds
+        """
+        self.count = count
+        self.timeout = timeout
+        self.interval = interval
+        self._identifier = os.getpid() & 0xFFFF
+        self._sequence = itertools.count()
+
+    def ping(self, address):
+        """
+        Pings a single host
+
+        :returns: a dict containing a key for success (true/false) and the performance data
+        """
+        return self.sweep([address])[address]
+
+    def sweep(self, addresses):
+        """
+        Pings all of the given hosts at the same time
+
+        :param addresses: list of IP addresses or hostnames
+
+        :returns: a dict of address to the ping result, each result has a success (true/false) and performance data key
+        """
+        result = {}
+        targets = {}
+
+        # resolve the hosts, any that don't resolve have failed already
+        for address in set(addresses):
+            try:
+                targets.setdefault(socket.gethostbyname(address), []).append(address)
+            except OSError:
+                logging.debug(f"Can't resolve {address}")
+                result[address] = self.__make_result({'received': 0, 'lost': self.count, 'rtt': 0})
+
+        if(targets):
+            stats = self.__run(list(targets.keys()))
+
+            for ip, addresses in targets.items():
+                for address in addresses:
+                    result[address] = self.__make_result(stats[ip])
+
+        return result
+
+    def __make_result(self, stats):
+        """success is true if less than 50% packet loss, lost packets count as the full timeout in the return time"""
+        total = stats['received'] + stats['lost']
+        packet_loss = stats['lost'] / total if total > 0 else 0
+        rta = (stats['rtt'] + stats['lost'] * self.timeout) * 1000 / total if total > 0 else 0
+
+        return {"success": stats['received'] > self.count / 2,
+                "performance_data": f"percent_packet_loss={packet_loss}% average_return_time={rta}ms"}
+
+    def __is_decided(self, stats):
+        """true once either enough replies are in for success or enough are lost for failure"""
+        needed = self.count // 2 + 1
+
+        return stats['received'] >= needed or stats['lost'] > self.count - needed
+
+    def __open_socket(self):
+        """opens a raw ICMP socket, falls back to an unprivileged ICMP socket if not running as root"""
+        try:
+            result = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+            raw = True
+        except PermissionError:
+            result = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+            raw = False
+
+        result.setblocking(False)
+
+        return result, raw
+
+    def __echo_request(self, sequence):
+        header = ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, 0, self._identifier, sequence)
+
+        return ICMP_HEADER.pack(ICMP_ECHO_REQUEST, 0, checksum(header + PAYLOAD), self._identifier, sequence) + PAYLOAD
+
+    def __read_reply(self, data, raw):
+        """:returns: the sequence number of an echo reply meant for this process, None otherwise"""
+        result = None
+
+        if(raw):
+            # raw sockets include the IP header
+            data = data[(data[0] & 0x0F) * 4:]
+
+        if(len(data) >= ICMP_HEADER.size):
+            message_type, _, _, identifier, sequence = ICMP_HEADER.unpack_from(data)
+
+            # unprivileged sockets replace the identifier with their own
+            if(message_type == ICMP_ECHO_REPLY and (identifier == self._identifier or not raw)):
+                result = sequence
+
+        return result
+
+    def __run(self, ips):
+        stats = {ip: {'sent': 0, 'received': 0, 'lost': 0, 'rtt': 0} for ip in ips}
+        pending = {}  # sequence -> (ip, send time)
+        next_send = time.monotonic()
+
+        sock, raw = self.__open_socket()
+        with sock:
+            while(len(stats) > sum(1 for s in stats.values() if s.get('done'))):
+                now = time.monotonic()
+
+                # send the next round of requests to every undecided host
+                if(now >= next_send):
+                    for ip, s in stats.items():
+                        if(not s.get('done') and s['sent'] < self.count):
+                            sequence = next(self._sequence) & 0xFFFF
+                            s['sent'] = s['sent'] + 1
+                            try:
+                                sock.sendto(self.__echo_request(sequence), (ip, 0))
+                                pending[sequence] = (ip, time.monotonic())
+                            except OSError:
+                                # network is unreachable, count it as lost now
+                                s['lost'] = s['lost'] + 1
+
+                    next_send = now + self.interval
+
+                # anything past the timeout is lost
+                for sequence, (ip, sent_at) in list(pending.items()):
+                    if(now - sent_at >= self.timeout):
+                        del pending[sequence]
+                        stats[ip]['lost'] = stats[ip]['lost'] + 1
+
+                self.__mark_decided(stats, pending)
+
+                # wait for replies until it is time to send again or the oldest request times out
+                deadlines = [sent_at + self.timeout for _, sent_at in pending.values()]
+                if(any(not s.get('done') and s['sent'] < self.count for s in stats.values())):
+                    deadlines.append(next_send)
+
+                wait_time = max(min(deadlines) - time.monotonic(), 0) if deadlines else 0
+                readable, _, _ = select.select([sock], [], [], wait_time)
+
+                while(readable):
+                    try:
+                        data, source = sock.recvfrom(1024)
+                    except BlockingIOError:
+                        break
+
+                    received_at = time.monotonic()
+                    sequence = self.__read_reply(data, raw)
+
+                    if(sequence in pending and pending[sequence][0] == source[0]):
+                        ip, sent_at = pending.pop(sequence)
+                        stats[ip]['received'] = stats[ip]['received'] + 1
+                        stats[ip]['rtt'] = stats[ip]['rtt'] + (received_at - sent_at)
+
+                self.__mark_decided(stats, pending)
+
+        return stats
+
+    def __mark_decided(self, stats, pending):
+        """sets hosts that have a final outcome as done and drops their outstanding requests"""
+        for ip, s in stats.items():
+            if(not s.get('done') and self.__is_decided(s)):
+                s['done'] = True
+
+                for sequence in [k for k, v in pending.items() if v[0] == ip]:
+                    del pending[sequence]
@@ -0,0 +1,120 @@
+"""
+index.py
+
+In memory index of the latest service results, for the service queries made by the web interface
+
+"""
+import re
+from threading import Lock
+
+
+class ServiceIndex:
+    """
+    Holds the latest result of every service along with indexes of the service ids by tag, return code, and host.
+    It's seeded from the database on startup and then updated with each batch of results once it is saved, so
+    service queries are answered without reading the database and show the same results as the saved hosts.
+    Results are held as saved, services are returned as copies so callers can change the top level values.
+    """
+    _services = None
+    _tags = None
+    _return_codes = None
+    _hosts = None
+    _lock = None
+
+    def __init__(self):
+        self._services = {}
+        self._tags = {}
+        self._return_codes = {}
+        self._hosts = {}
+        self._lock = Lock()
+
+    def load(self, services):
+        """
+        Loads the initial service results
+
+        :param services: list of service dicts, as saved in the database
+        """
+        with self._lock:
+            for s in services:
+                self.__add(s)
+
+    def update(self, batch):
+        """
+        Replaces the services of each host with its latest results. Services no longer returned for a host are removed
+
+        :param batch: list of host status dicts, including the services
+        """
+        with self._lock:
+            for host_status in batch:
+                self.__remove_host(host_status['id'])
+
+                for s in host_status['services']:
+                    self.__add(s)
+
+    def set_hosts(self, host_ids):
+        """
+        Removes the services of hosts that are no longer in the config
+
+        :param host_ids: list of host ids from the config
+        """
+        with self._lock:
+            for host_id in set(self._hosts) - set(host_ids):
+                self.__remove_host(host_id)
+
+    def get_tag(self, tag_id):
+        """ finds services matching the given tag id, see HostHistory.get_tag() """
+        with self._lock:
+            return {"id": tag_id, "services": self.__get(self._tags.get(tag_id, ()))}
+
+    def get_services(self, return_codes=[0], service_filter=".*"):
+        """ returns the services with one of the return codes and an id matching the filter, see HostHistory.get_services() """
+        pattern = re.compile(service_filter)
+
+        with self._lock:
+            service_ids = set().union(*[self._return_codes.get(int(r), ()) for r in return_codes])
+
+            # filter the ids before copying the services
+            return self.__get([s for s in service_ids if pattern.search(s)])
+
+    def get_service(self, service_id):
+        """ get information on a specific service, see HostHistory.get_service() """
+        with self._lock:
+            service = self._services.get(service_id)
+
+            return dict(service) if service is not None else {}
+
+    def __get(self, service_ids):
+        """ copies of the services, sorted by id. Must hold the lock """
+        return [dict(self._services[s]) for s in sorted(service_ids)]
+
+    def __add(self, service):
+        """ adds the service to the indexes, replacing any result for the same id. Must hold the lock """
+        if(service['id'] in self._services):
+            self.__remove(service['id'])
+
+        self._services[service['id']] = service
+        self._return_codes.setdefault(service['return_code'], set()).add(service['id'])
+        self._hosts.setdefault(service['host']['id'], set()).add(service['id'])
+        for tag in service.get('tags', []):
+            self._tags.setdefault(tag, set()).add(service['id'])
+
+    def __remove(self, service_id):
+        """ removes the service from the indexes. Must hold the lock """
+        service = self._services.pop(service_id)
+
+        self.__discard(self._return_codes, service['return_code'], service_id)
+        self.__discard(self._hosts, service['host']['id'], service_id)
+        for tag in service.get('tags', []):
+            self.__discard(self._tags, tag, service_id)
+
+    def __remove_host(self, host_id):
+        for service_id in list(self._hosts.get(host_id, ())):
+            self.__remove(service_id)
+
+    def __discard(self, index, key, service_id):
+        """ removes the id from the index entry, dropping the entry once it's empty """
+        ids = index.get(key)
+        if(ids is not None):
+            ids.discard(service_id)
+            if(not ids):
+                del index[key]
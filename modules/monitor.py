@@ -1,21 +1,29 @@
-import datetime
 import jinja2
 import json
 import logging
 import os.path
-import subprocess
 import time
-import re
 import modules.jinja_custom as jinja_custom
+import modules.perfdata as perfdata
 import modules.utils as utils
-from random import randint
+from concurrent.futures import ThreadPoolExecutor
 from slugify import slugify
 from threading import Lock
 from functools import reduce
 from modules.device import HostType
-from pythonping import ping
+from modules.events import StateDiff
+from modules.graph import HostGraph
+from modules.icmp import PingSweep
+from modules.plugins import PythonCall
+from modules.results import ResultStore
+from modules.stats import CheckStats
+from modules.runner import ServiceRunner
+from modules.scheduler import CheckScheduler
 from modules.exceptions import DeviceNotFoundError, ServiceNotFoundError
 
+# removes performance data from service output
+DEFAULT_OUTPUT_FILTER = "{{ (value | string).split('|') | first }}"
+
 
 class HostMonitor:
     """
@@ -26,47 +34,110 @@ class HostMonitor:
     types = None
     services = None
     hosts = None
+    graph = None
     history = None
     custom_jinja_constants = {}
+    max_checks = 8
+    max_host_checks = 2
+    runner = None
+    scheduler = None
+    pinger = None
+    results = None
+    events = None
+    stats = None
     _jinja = None
+    _templates = None
     lock = Lock()  # lock for host updating functions
 
     def __init__(self, history, yaml_file):
-        # create the host type and services definitions, load history
-        self.types = self.__create_types(yaml_file['types'], yaml_file['config']['default_interval'], yaml_file['config']['service_check_attempts'])
-        self.services = yaml_file['services']
         self.hosts = {}
         self.history = history
 
+        # limits on how many checks can run at once, overall and per host
+        self.max_checks = yaml_file['config']['max_concurrent_checks']
+        self.runner = ServiceRunner(self.max_checks)
+        self.scheduler = CheckScheduler()
+        self.pinger = PingSweep()
+        self.stats = CheckStats()
+
         # load jinja environment
         self._jinja = jinja2.Environment()
         self._jinja.globals['default'] = jinja_custom.load_default
         self._jinja.globals['path'] = os.path.join
-
-        # if any global paths were set for the jinja environment
-        if('jinja_constants' in yaml_file['config']):
-            self.custom_jinja_constants = yaml_file['config']['jinja_constants']
+        self._templates = {}
 
         if(yaml_file['config']['check_on_startup']):
             # set to 1 hour day if we are forcing a check on startup
             logging.info("Forcing host check on startup")
 
-        # get host description by type
-        now = datetime.datetime.now()
-        for i in range(0, len(yaml_file['hosts'])):
-            device = self.__create_device(yaml_file['hosts'][i])
+        self.load_config(yaml_file)
 
-            from_history = self.history.get_host(device.id)
-            if(from_history and not yaml_file['config']['check_on_startup']):
-                # use the saved next check time
-                device.next_check = from_history['next_check']
-            else:
-                # set the next check time to now
-                next_check_now = now + datetime.timedelta(minutes=-1)
-                device.next_check = next_check_now.strftime(utils.TIME_FORMAT)
+        # last known service results, used to determine state changes and change events
+        services = self.history.get_services([0, 1, 2, 3])
+        self.results = ResultStore()
+        self.results.load(services)
+        self.events = StateDiff()
+        self.events.load(services)
 
-            self.hosts[device.id] = device
-            logging.info(f"Loading device {device.name} with check interval every {device.interval} min")
+    def load_config(self, yaml_file):
+        """loads the host types, services, and hosts from the config. This can be called again
+        to reload a changed config file, hosts that already exist keep their current check schedule
+        """
+        with self.lock:
+            # create the host type definitions
+            config = yaml_file['config']
+            types = self.__create_types(yaml_file['types'], config['default_interval'], config['service_check_attempts'])
+
+            # get host description by type
+            now = time.time()
+            old_hosts = self.hosts
+            hosts = {}
+            for i in range(0, len(yaml_file['hosts'])):
+                device = self.__create_device(yaml_file['hosts'][i], types)
+
+                hosts[device.id] = device
+                logging.info(f"Loading device {device.name} with check interval every {device.interval} min")
+
+            # check the parents are valid before replacing the current config
+            self.graph = HostGraph({id: h.parents for id, h in hosts.items()})
+            self.types = types
+            self.hosts = hosts
+            self.services = yaml_file['services']
+            self.max_host_checks = config['max_host_checks']
+            self.runner.cache_ttl = config['check_cache_ttl']
+
+            # if any global paths were set for the jinja environment
+            self.custom_jinja_constants = config['jinja_constants'] if 'jinja_constants' in config else {}
+
+            # spread the hosts evenly across their check intervals
+            self.scheduler.set_phases({id: h.interval * 60 for id, h in self.hosts.items()})
+            load = self.get_schedule_load()
+            logging.info(f"Expecting {load['average_checks']:.1f} checks per minute, at most {load['max_checks']}")
+
+            for device in self.hosts.values():
+                from_history = self.history.get_host(device.id)
+                if(device.id in old_hosts):
+                    # keep the current schedule
+                    device.last_check = old_hosts[device.id].last_check
+                    device.next_check = old_hosts[device.id].next_check
+                    device.silenced = old_hosts[device.id].silenced
+                elif(from_history and not config['check_on_startup'] and from_history['next_check'] > now):
+                    # use the saved next check time
+                    device.next_check = from_history['next_check']
+                    self.scheduler.schedule(device.id, device.next_check)
+                else:
+                    # the host is due, ramp up the first checks instead of running them all now
+                    device.next_check = self.scheduler.ramp_slot(device.id, config['startup_ramp'] * 60, now)
+                    self.scheduler.schedule(device.id, device.next_check)
+
+            # stop checking hosts that were removed
+            for id in old_hosts.keys() - self.hosts.keys():
+                self.scheduler.remove(id)
+
+            self.__compile_templates()
+
+            # pick up any changes to python plugin files
+            self.runner.reload_plugins()
 
         # save a list of all valid hosts
         self.history.set_hosts(self.get_hosts())
@@ -82,27 +153,53 @@ class HostMonitor:
 
         return result
 
-    def __create_device(self, device_def):
+    def __create_device(self, device_def, types):
         """Create a host device type based on defined YAML"""
         result = None
 
-        if(device_def['type'] in self.types):
-            result = self.types[device_def['type']].create_device(device_def)
+        if(device_def['type'] in types):
+            result = types[device_def['type']].create_device(device_def)
         else:
             raise DeviceNotFoundError(device_def['name'], device_def['type'])
 
         return result
 
+    def __compile_templates(self):
+        """compiles the command, argument, and output filter templates for every service type and host
+        templates are cached by their source string so they are only compiled once per config load
+        """
+        templates = {DEFAULT_OUTPUT_FILTER: self._jinja.from_string(DEFAULT_OUTPUT_FILTER)}
+
+        # the service command and arguments
+        for serviceObj in self.services.values():
+            for t_string in [serviceObj['command']] + serviceObj.get('args', []):
+                if(t_string not in templates):
+                    templates[t_string] = self._jinja.from_string(str(t_string))
+
+        # any custom output filters set on host services
+        for aHost in self.hosts.values():
+            for service in aHost.get_services():
+                if('output_filter' in service and service['output_filter'] not in templates):
+                    templates[service['output_filter']] = self._jinja.from_string(service['output_filter'])
+
+        # swap in the new cache, this drops templates from any previous config
+        self._templates = templates
+        logging.debug(f"Compiled {len(templates)} templates")
+
     def __render_template(self, t_string, jinja_vars):
         """renders template string using Jinja environment and returns the result"""
-        template = self._jinja.from_string(t_string)
+        template = self._templates.get(t_string)
+
+        if(template is None):
+            template = self._jinja.from_string(str(t_string))
+            self._templates[t_string] = template
 
         return template.render(jinja_vars).strip()
 
     def __create_service_call(self, service, host_config):
         """creates the service call based on the defined service definition and supplied arguments
         function will run all arguments through Jinja templates to fully expand and then return an array
-        that can be sent to the __run_process function
+        that can be sent to the __run_process function. Python plugin services return a PythonCall instead
         """
         result = None
 
@@ -114,82 +211,39 @@ class HostMonitor:
 
             jinja_vars.update(self.custom_jinja_constants)  # add any custom constants
 
-            # set the command first and then slot the arg values
-            result = self.__render_template(serviceObj['command'], jinja_vars).split(' ')
-
             # load the arg values
             args = []
             if('args' in serviceObj):
                 args = [self.__render_template(arg, jinja_vars) for arg in serviceObj['args']]
 
-            # return everything as one array
-            result = result + args
+            if(serviceObj['type'] == 'python'):
+                # the command is the path to the plugin file
+                result = PythonCall(self.__render_template(serviceObj['command'], jinja_vars), serviceObj['function'], tuple(args),
+                                    serviceObj['isolated'])
+            else:
+                # set the command first and then slot the arg values, return everything as one array
+                result = self.__render_template(serviceObj['command'], jinja_vars).split(' ') + args
         else:
             raise ServiceNotFoundError(service['type'])
 
         return result
 
-    def __parse_perf_data(self, service_id, service_output):
-        """ parses the perf data according to the Nagios format:
-        https://nagios-plugins.org/doc/guidelines.html#AEN200
-        """
-        result = []
-        perf_order = ["value", "warning", "critical", "min", "max"]
-
-        # determine if there is any perf data
-        perf_string = service_output.strip().split("|")
-        if(len(perf_string) > 1):
-            # this should get each perf data value sequence
-            # this regex allows for quotes within a perf sequence
-            for p in re.finditer("(\"[^\"]*\"|'[^']*'|[\\S]+)+", perf_string[1].strip()):
-
-                # find all the numeric values
-                values = []
-                for t in re.finditer("(=|;)[+-]?((\\d+(\\.\\d+)?)|(\\.\\d+))|;", p.group()):
-                    values.append(t.group()[1:])
-
-                # map the values to the appropriate keys, filter out blank values
-                mapping = {perf_order[i]: values[i] for i in range(0, len(values)) if values[i].strip() != ''}
-
-                # get the label and unit of measure
-                first_key = p.group().strip().split(";")[0].split("=")
-                unit_of_measure = first_key[1][len(mapping["value"]):]
-
-                # convert values to decimals
-                mapping = {k: float(v) for k, v in mapping.items()}
-
-                # add in the label and unit of measure
-                p_id = slugify(first_key[0]) if slugify(first_key[0].strip()) != '' else 'root'
-                mapping['id'] = f"{service_id}-{p_id}"
-                mapping['label'] = first_key[0].replace("'", "")
-
-                # only add if it exists
-                if(unit_of_measure != ""):
-                    mapping['uom'] = unit_of_measure
-
-                result.append(mapping)
-
-        return result
-
     # executes a subprocess (python script) and returns the results
-    def __run_process(self, program, args):
+    def __run_process(self, command, timeout):
         """
-        Kicks off a subprocess to run the defined program
-        with the given arguments. Returns subprocess output.
+        Kicks off a subprocess to run the defined command, it will be killed if it runs
+        longer than the timeout. Returns subprocess output.
         """
-        command = program + args
-        logging.debug(command)
-        # run process, pipe all output
-        output = subprocess.run(command, encoding="utf-8", stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-
-        return output
+        return self.runner.run(command, timeout)
 
-    def __check_host(self, host):
+    def __check_host(self, host, ping_result=None):
         """
         Called to run the checks on a specific host. If the ping command fails all subsequent checks are skipped
-        and a result listing them as Not Attempted (return code of 3) is used.
+        and a result listing them as Not Attempted (return code of 3) is used. If the host was already pinged
+        the ping_result is used instead of pinging it again.
         """
         result = host.serialize()
+        result['unreachable'] = False
 
         services = host.get_services()
         service_results = []
@@ -198,11 +252,14 @@ class HostMonitor:
         is_alive = False
 
         if(host.ping_command is None):
-            is_alive = self._ping(host.address)
+            is_alive = ping_result if ping_result is not None else self._ping(host.address)
         else:
-            output = self.__run_process(self.__create_service_call(host.ping_command, host.config), [])
+            output = self.__run_process(self.__create_service_call(host.ping_command, host.config), host.ping_command['timeout'])
             is_alive = {"success": True if output.returncode == 0 else False, "performance_data": ""}
 
+            if(not output.shared):
+                self.stats.record(f"{host.id}-alive", host.ping_command['type'], host.id, output.usage)
+
         if(is_alive['success']):
             logging.debug(f"{host.name}: Is Alive")
 
@@ -223,6 +280,33 @@ class HostMonitor:
 
         return result
 
+    def __down_parents(self, host_id, graph):
+        """
+        A host is unreachable when all of its parents are down or unreachable, based on the last result of
+        their Alive check. Parents that haven't been checked yet are assumed to be up.
+
+        :returns: list of the down parent ids if the host is unreachable, an empty list otherwise
+        """
+        parents = graph.get_parents(host_id)
+        down = [p for p in parents if self.results.get(f"{p}-alive").get('return_code', 0) != 0]
+
+        return down if len(down) == len(parents) else []
+
+    def __unreachable_host(self, host, parents):
+        """
+        Creates the result for a host that can't be reached because its parents are down. Nothing is run,
+        the Alive check and all services are set as Unknown (return code of 3)
+        """
+        result = host.serialize()
+        result['unreachable'] = True
+
+        service_results = [self.__make_service_output(host, service, 3, "Not attempted") for service in host.get_services()]
+        service_results.append(self.__make_service_output(host, {'name': "Alive"}, 3, f"Unreachable, parent hosts are down: {', '.join(parents)}"))
+
+        result['services'] = sorted(service_results, key=lambda s: s['name'])
+
+        return result
+
     def _ping(self, address):
         """
         Will attempt to ping the IP address via ICMP and return True or False
@@ -230,30 +314,15 @@ class HostMonitor:
 
         :returns: a dict containing a key for succcess (true/false) and the performance data
         """
-        responses = ping(address, verbose=False, count=5)
+        return self.pinger.ping(address)
 
-        # get percent packet loss and averate return time
-        total_success = 0
-        rta = 0
-        for r in responses:
-            total_success = total_success + 1 if r.success is True else total_success
-            rta = rta + r.time_elapsed_ms
-
-        packet_loss = 1 - (total_success / len(responses))
-        rta = rta / len(responses)
-
-        # if less than 50% packet loss
-        return {"success": True if (packet_loss < .5) else False,
-                "performance_data": f"percent_packet_loss={packet_loss}% average_return_time={rta}ms"}
-
-    def __make_service_output(self, host, service, return_code, text):
+    def __make_service_output(self, host, service, return_code, text, usage=None):
         """Helper method to take the name, return_code, and output and wrap
-        it in a Dict.
+        it in a Dict. Resource usage is included for checks that ran a command.
         """
         service_id = f"{host.id}-{slugify(service['name'])}"
-        now = datetime.datetime.now()
         result = {"name": service['name'], "return_code": return_code, "text": text, "raw_text": text, "id": service_id,
-                  "check_attempt": 1, "state": utils.CONFIRMED_STATE, "last_state_change": now.strftime(utils.TIME_FORMAT),
+                  "check_attempt": 1, "state": utils.CONFIRMED_STATE, "last_state_change": time.time(),
                   "host": {"id": host.id, "name": host.name},
                   "tags": service['tags'] if 'tags' in service else []}
 
@@ -265,11 +334,11 @@ class HostMonitor:
         if(utils.is_json(text)):
             jinja_vars['value'] = json.loads(text)
 
-        jinja_template = service['output_filter'] if 'output_filter' in service else "{{ (value | string).split('|') | first }}"
+        jinja_template = service['output_filter'] if 'output_filter' in service else DEFAULT_OUTPUT_FILTER
         result['text'] = self.__render_template(jinja_template, jinja_vars)
 
         # generate the performance data (per nagios spec)
-        perf_data = self.__parse_perf_data(service_id, result['raw_text'])
+        perf_data = perfdata.parse_perf_data(service_id, result['raw_text'])
         if(perf_data):
             result['perf_data'] = perf_data
 
@@ -281,8 +350,11 @@ class HostMonitor:
         if('notifier' in service):
             result['notifier'] = service['notifier']
 
+        if(usage is not None):
+            result['usage'] = usage
+
         # determine check attempts and service state (skip OK and Unknown states)
-        old_service = self.history.get_service(service_id)
+        old_service = self.results.get(service_id)
         if(old_service):
             # check if return code has changed to non-OK state - if max_check is = 1 skip unconfirmed states
             if(old_service['return_code'] != return_code and return_code in [1, 2] and host.check_attempts > 1):
@@ -299,62 +371,127 @@ class HostMonitor:
             if((old_service['return_code'] == return_code and old_service['state'] == result['state']) or result['state'] == utils.UNCONFIRMED_STATE):
                 result['last_state_change'] = old_service['last_state_change']
 
+        self.results.update(result)
+
         return result
 
     def __custom_checks(self, services, host):
-        """run defined custom service checks from a host given the current host configuration"""
+        """run defined custom service checks from a host given the current host configuration
+        up to max_host_checks services are run at the same time for each host. Services that render to the same
+        command as another service in this cycle share its output, but are still filtered and given a state separately
+        """
+        calls = [(self.__create_service_call(s, host.config), s['timeout']) for s in services]
+        outputs = self.runner.run_all(calls, self.max_host_checks)
+
         result = []
+        for s, output in zip(services, outputs):
+            service_output = self.__make_service_output(host, s, output.returncode, output.stdout, output.usage)
+            result.append(service_output)
 
-        for s in services:
-            output = self.__run_process(self.__create_service_call(s, host.config), [])
-            result.append(self.__make_service_output(host, s, output.returncode, output.stdout))
-            time.sleep(1)
+            # only count the cost of commands that were run for this service
+            if(not output.shared):
+                self.stats.record(service_output['id'], s['type'], host.id, output.usage)
 
         return result
 
+    def __host_status(self, aHost, host_check, now):
+        """summarizes the service results of a completed host check and sets the next
+        check time on the host
+        """
+        # figure out the overall worst status
+        overall_status = reduce(lambda x, y: x if x['return_code'] > y['return_code'] else y, host_check['services'])
+        host_check['overall_status'] = overall_status['return_code']
+
+        # figure out if the host is alive at all
+        host_alive = list(filter(lambda x: x['id'] == f"{aHost.id}-alive", host_check['services']))
+        host_check['alive'] = host_alive[0]['return_code']
+
+        if(host_alive[0]['return_code'] > 0):
+            # if the host isn't alive that is the overall status
+            host_check['overall_status'] = host_alive[0]['return_code']
+
+        # create a slug to act as the id for lookups
+        host_check['id'] = aHost.id
+
+        # save the last and caclulate next check date
+        aHost.last_check = now
+        host_check['last_check'] = aHost.last_check
+
+        # the next check is on the host's phase, keeping checks spread out. Due hosts are taken off the schedule
+        # while they're checked, so a due time here is from check_now() during the check and is kept if it's earlier
+        aHost.next_check = self.scheduler.next_slot(aHost.id, now)
+        pending = self.scheduler.get_due_time(aHost.id)
+        if(pending is not None):
+            aHost.next_check = min(pending, aHost.next_check)
+        host_check['next_check'] = aHost.next_check
+        self.scheduler.schedule(aHost.id, aHost.next_check)
+
+        return host_check
+
     def check_hosts(self):
         """runs host checks on any host currently outside of their check interval
-        the the updated hosts are returned as an array"""
+        the the updated hosts are returned as an array. Hosts are checked in parallel, up to
+        max_checks at the same time. Parent hosts are checked before their children"""
         result = []
-        now = datetime.datetime.now()
+        now = time.time()
 
         with self.lock:
-            for id, aHost in self.hosts.items():
-                # check if we need to check this host,
-                next_check = datetime.datetime.strptime(aHost.next_check, utils.TIME_FORMAT)
-                if(next_check < now):
-                    logging.debug(f"Checking {aHost.name}")
+            # find all the hosts we need to check
+            due_hosts = {id: self.hosts[id] for id in self.scheduler.pop_due(now)}
+            graph = self.graph
+
+        # identical service commands are only run once in this cycle
+        self.runner.new_cycle()
 
-                    host_check = self.__check_host(aHost)
+        for aHost in due_hosts.values():
+            logging.debug(f"Checking {aHost.name}")
 
-                    # figure out the overall worst status
-                    overall_status = reduce(lambda x, y: x if x['return_code'] > y['return_code'] else y, host_check['services'])
-                    host_check['overall_status'] = overall_status['return_code']
+        host_checks = []
+        with ThreadPoolExecutor(max_workers=self.max_checks, thread_name_prefix='host-check') as executor:
+            # check parents before their children, children of down parents are not checked
+            for level in graph.levels(list(due_hosts.keys())):
+                down_parents = {id: self.__down_parents(id, graph) for id in level}
+                reachable = [due_hosts[id] for id in level if not down_parents[id]]
 
-                    # figure out if the host is alive at all
-                    host_alive = list(filter(lambda x: x['id'] == f"{aHost.id}-alive", host_check['services']))
-                    host_check['alive'] = host_alive[0]['return_code']
+                # ping all the hosts using the default ICMP check in one sweep
+                ping_results = self.pinger.sweep([aHost.address for aHost in reachable if aHost.ping_command is None])
 
-                    if(host_alive[0]['return_code'] > 0):
-                        # if the host isn't alive that is the overall status
-                        host_check['overall_status'] = host_alive[0]['return_code']
+                checks = executor.map(lambda h: self.__check_host(h, ping_results.get(h.address)), reachable)
+                host_checks = host_checks + list(zip(reachable, checks))
+                for id in [id for id in level if down_parents[id]]:
+                    host_checks.append((due_hosts[id], self.__unreachable_host(due_hosts[id], down_parents[id])))
 
-                    # create a slug to act as the id for lookups
-                    host_check['id'] = aHost.id
+        with self.lock:
+            for aHost, host_check in host_checks:
+                # skip hosts removed by a config reload during the check
+                if(aHost.id in self.hosts):
+                    result.append(self.__host_status(self.hosts[aHost.id], host_check, now))
+
+        result = sorted(result, key=lambda o: o['name'])
+
+        # send out anything that changed
+        self.events.diff(result)
+
+        return result
+
+    def get_schedule_load(self, minutes=60):
+        """
+        Reports the expected number of checks started each minute once all hosts are on their time slot,
+        each host counts as one check for the alive check plus one for each service
 
-                    # save the last and caclulate next check date
-                    aHost.last_check = now.strftime(utils.TIME_FORMAT)
-                    host_check['last_check'] = aHost.last_check
+        :param minutes: the number of minutes to report on
 
-                    #  add or subtract a bit from each check interval to help with system load
-                    next_check = now + datetime.timedelta(minutes=(aHost.interval), seconds=randint(-60, 60))
-                    aHost.next_check = next_check.strftime(utils.TIME_FORMAT)
-                    host_check['next_check'] = aHost.next_check
+        :returns: dict with the hosts and checks expected in each minute
+        """
+        weights = {id: len(h.get_services()) + 1 for id, h in self.hosts.items()}
+        checks = self.scheduler.get_load(weights, minutes)
 
-                    self.hosts[id] = aHost
-                    result.append(host_check)
+        return {"minutes": minutes, "hosts": self.scheduler.get_load(minutes=minutes), "checks": checks,
+                "max_checks": max(checks), "average_checks": sum(checks) / minutes}
 
-        return sorted(result, key=lambda o: o['name'])
+    def wait(self, max_wait):
+        """blocks until the next host check is due, or max_wait seconds have passed"""
+        self.scheduler.wait(max_wait)
 
     def get_hosts(self):
         return sorted([h.id for h in self.hosts.values()])
@@ -371,8 +508,9 @@ class HostMonitor:
         if(aHost is not None):
             with self.lock:
                 # reset the next check time and update the host
-                aHost.next_check = datetime.datetime.now().strftime(utils.TIME_FORMAT)
+                aHost.next_check = time.time()
                 self.hosts[id] = aHost
+                self.scheduler.schedule(id, aHost.next_check)
 
                 result['next_check'] = aHost.next_check
                 result['success'] = True
@@ -381,7 +519,7 @@ class HostMonitor:
 
     def silence_host(self, id, until):
         """sets the silenced property on a host which will expire when the current time
-        exceeds the given datetime object
+        exceeds the given unix timestamp
         """
         result = {"success": False}
 
@@ -389,8 +527,8 @@ class HostMonitor:
 
         if(aHost is not None):
             with self.lock:
-                # set the host as silenced until this datetime
-                aHost.silenced = until.strftime(utils.TIME_FORMAT)
+                # set the host as silenced until this time
+                aHost.silenced = until
                 self.hosts[id] = aHost
 
                 logging.debug(f"Silencing {id} until {aHost.silenced}")
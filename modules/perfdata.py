@@ -0,0 +1,90 @@
+"""
+perfdata.py
+
+Parses performance data from service check output according to the Nagios plugin guidelines
+https://nagios-plugins.org/doc/guidelines.html#AEN200
+
+"""
+import re
+from functools import lru_cache
+from slugify import slugify
+
+# a single 'label'=value[UOM];[warn];[crit];[min];[max] sequence, labels can be quoted to include spaces
+PERF_PATTERN = re.compile(r"""('(?:[^']|'')*'|"[^"]*"|[^\s='"]+)=([^;\s]*)(?:;([^;\s]*))?(?:;([^;\s]*))?(?:;([^;\s]*))?(?:;([^;\s]*))?""")
+
+# the numeric part of a value or threshold, anything after a value is the unit of measure
+NUMBER_PATTERN = re.compile(r"[+-]?(?:\d+(?:\.\d+)?|\.\d+)")
+
+# order of the values after the label
+PERF_ORDER = ("value", "warning", "critical", "min", "max")
+
+
+@lru_cache(maxsize=4096)
+def _perf_id(label):
+    """slugify the label for use in the perf data id, labels without any valid characters are 'root'"""
+    result = slugify(label)
+
+    return result if result != '' else 'root'
+
+
+def get_perf_string(service_output):
+    """
+    Pulls the performance data out of the service output. Per the guidelines perf data follows the first |
+    on the first line, and can continue after a second | following any long text output
+
+    :param service_output: the full output from the service check
+
+    :returns: the performance data as a single string, empty if there isn't any
+    """
+    sections = service_output.strip().split("|", 2)
+    result = ""
+
+    if(len(sections) > 1):
+        # the first line only, anything after is long text output
+        result = sections[1].split("\n", 1)[0]
+
+        if(len(sections) > 2):
+            result = f"{result} {sections[2]}"
+
+    return result
+
+
+def parse_perf_data(service_id, service_output):
+    """
+    Parses all perf data from the service output in one pass. Metrics without a numeric value
+    (such as U for undetermined) are skipped.
+
+    :param service_id: the id of the service, used to create an id for each metric
+    :param service_output: the full output from the service check
+
+    :returns: list of dicts, one for each metric
+    """
+    result = []
+
+    for p in PERF_PATTERN.finditer(get_perf_string(service_output)):
+        label = p.group(1)
+        value = NUMBER_PATTERN.match(p.group(2))
+
+        if(value is None):
+            continue
+
+        mapping = {"value": float(value.group())}
+
+        # thresholds and min/max are optional and can be left blank
+        for i in range(3, 7):
+            threshold = NUMBER_PATTERN.match(p.group(i)) if p.group(i) else None
+
+            if(threshold is not None):
+                mapping[PERF_ORDER[i - 2]] = float(threshold.group())
+
+        mapping['id'] = f"{service_id}-{_perf_id(label)}"
+        mapping['label'] = label[1:-1].replace("''", "'") if label.startswith("'") else label
+
+        # only add if it exists
+        unit_of_measure = p.group(2)[value.end():]
+        if(unit_of_measure != ""):
+            mapping['uom'] = unit_of_measure
+
+        result.append(mapping)
+
+    return result
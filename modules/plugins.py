@@ -0,0 +1,247 @@
+"""
+plugins.py
+
+Runs Python service checks inside the monitor instead of starting a new interpreter for each check
+
+A plugin is a Python file with an entry point function, check() by default. The function is given the rendered
+service arguments as a list and must return a tuple of (return_code, output).
+
+This file is also run directly as an isolated worker process, so it should only import from the standard library
+and the plugin loading dependencies.
+
+"""
+import asyncio
+import importlib.util
+import logging
+import os
+import resource
+import signal
+import socket
+import subprocess
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from slugify import slugify
+from threading import BoundedSemaphore, Lock
+
+# a call to a Python plugin, args is a tuple of rendered arguments
+PythonCall = namedtuple('PythonCall', ['path', 'function', 'args', 'isolated'])
+
+# plugins already loaded in this process, by path
+_loaded = {}
+_load_lock = Lock()
+
+
+def load_plugin(path):
+    """loads the Python file at this path as a module, each file is only loaded once"""
+    with _load_lock:
+        if(path not in _loaded):
+            spec = importlib.util.spec_from_file_location(f"trash_panda_plugin_{slugify(path, separator='_')}", path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+
+            _loaded[path] = module
+
+        return _loaded[path]
+
+
+def call_plugin(path, function, args):
+    """
+    Calls the entry point of a plugin. This is also the function run by isolated worker processes
+
+    :returns: tuple of the return code, output, and the (user, system) CPU time of the call
+    """
+    start = resource.getrusage(resource.RUSAGE_THREAD)
+
+    try:
+        result = getattr(load_plugin(path), function)(list(args))
+
+        if(not isinstance(result, (tuple, list)) or len(result) != 2 or not isinstance(result[0], int)):
+            raise ValueError(f"{function}() must return a tuple of (return_code, output), got {result!r}")
+
+        return_code, output = result[0], str(result[1])
+    except Exception as e:
+        logging.error(f"Error running plugin {path}: {e}")
+        return_code, output = 3, f"Plugin error: {e}"
+
+    end = resource.getrusage(resource.RUSAGE_THREAD)
+
+    return return_code, output, (end.ru_utime - start.ru_utime, end.ru_stime - start.ru_stime)
+
+
+class PluginWorker:
+    """
+    An isolated worker process that runs one plugin call at a time. The worker is this file started as a new
+    interpreter, so it doesn't load the monitor or copy its memory. Calls and results are sent over a socket pair.
+    """
+    process = None
+    generation = 0
+    _conn = None
+
+    def __init__(self, generation):
+        """
+        :param generation: the plugin generation this worker was started in, workers from older generations are stopped
+        """
+        parent, child = socket.socketpair()
+        self.process = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(child.fileno())], pass_fds=[child.fileno()],
+                                        stdin=subprocess.DEVNULL)
+        child.close()
+
+        self._conn = Connection(parent.detach())
+        self.generation = generation
+
+    def call(self, call, timeout):
+        """
+        Runs the plugin call in the worker and waits for the result
+
+        :param call: a PythonCall
+        :param timeout: how long the plugin is allowed to run, in seconds
+
+        :returns: the call_plugin() result
+        :raises TimeoutError: if the plugin is still running after the timeout
+        :raises EOFError: if the worker stopped without returning a result
+        """
+        self._conn.send((call.path, call.function, call.args))
+
+        if(not self._conn.poll(timeout)):
+            raise TimeoutError()
+
+        return self._conn.recv()
+
+    def stop(self):
+        """kills the worker process"""
+        self.process.kill()
+        self.process.wait()
+        self._conn.close()
+
+
+class PythonPlugins:
+    """
+    Runs Python plugins from the ServiceRunner event loop. Plugins run on a thread pool within this process, or
+    in their own worker processes if they are isolated. Each isolated call has a worker to itself, a worker is kept
+    for the next call unless its plugin crashes or hangs, then only that worker is killed.
+
+    Plugins running in process can't be stopped if they hang, their result is ignored once the timeout is hit and
+    the plugin is run isolated from then on. The hung call keeps its thread, while every thread is held by a
+    plugin that timed out other in process calls fail instead of waiting for one.
+    """
+    max_workers = 8
+    _threads = None
+    _waiters = None
+    _free = None
+    _hung = None
+    _idle = None
+    _generation = 0
+    _workers_lock = None
+
+    def __init__(self, max_workers):
+        self.max_workers = max_workers
+        self._threads = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='plugin')
+        self._waiters = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='plugin-worker')
+        self._free = BoundedSemaphore(max_workers)
+        self._hung = set()
+        self._idle = []
+        self._workers_lock = Lock()
+
+    def clear(self):
+        """drops all loaded plugins so they'll be loaded again on the next call"""
+        with _load_lock:
+            _loaded.clear()
+
+        # plugins that timed out may have been fixed, try them in process again
+        self._hung = set()
+
+        # running workers are stopped once their call finishes
+        with self._workers_lock:
+            self._generation = self._generation + 1
+            idle = self._idle
+            self._idle = []
+
+        for worker in idle:
+            worker.stop()
+
+    async def run(self, call, timeout):
+        """
+        Runs the plugin call
+
+        :param call: a PythonCall
+        :param timeout: how long the plugin is allowed to run, in seconds
+
+        :returns: tuple of the return code, output, and resource usage dict
+        """
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        cpu = (None, None)
+
+        if(call.isolated or (call.path, call.function) in self._hung):
+            # the waiting thread waits out the timeout itself
+            return_code, output, cpu = await loop.run_in_executor(self._waiters, self.__run_isolated, call, timeout)
+        elif(not self._free.acquire(blocking=False)):
+            # only calls that timed out can still be running, anything else is limited by the runner
+            logging.error(f"All {self.max_workers} plugin threads are held by plugins that timed out, can't run {call.path}")
+            return_code, output = 3, "No plugin threads free, plugins that timed out are still running"
+        else:
+            future = self._threads.submit(call_plugin, call.path, call.function, call.args)
+            future.add_done_callback(lambda f: self._free.release())
+
+            try:
+                return_code, output, cpu = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Plugin timed out after {timeout} seconds, it will run in an isolated worker from now on: {call.path}")
+                self._hung.add((call.path, call.function))
+                return_code, output = 3, f"Check timed out after {timeout} seconds"
+
+        return return_code, output, {"wall_time": time.monotonic() - start, "user_time": cpu[0], "system_time": cpu[1], "max_rss": None}
+
+    def __run_isolated(self, call, timeout):
+        """runs the call on an idle worker, or a new one if none are idle. Only this worker is killed if the plugin fails"""
+        with self._workers_lock:
+            worker = self._idle.pop() if self._idle else None
+            generation = self._generation
+
+        try:
+            if(worker is None):
+                worker = PluginWorker(generation)
+
+            result = worker.call(call, timeout)
+        except TimeoutError:
+            logging.warning(f"Plugin timed out after {timeout} seconds: {call.path}")
+            worker.stop()
+            return 3, f"Check timed out after {timeout} seconds", (None, None)
+        except (EOFError, OSError):
+            logging.error(f"Plugin worker process crashed running {call.path}")
+            if(worker is not None):
+                worker.stop()
+            return 3, "Plugin worker process crashed", (None, None)
+
+        with self._workers_lock:
+            keep = worker.generation == self._generation
+            if(keep):
+                self._idle.append(worker)
+
+        if(not keep):
+            worker.stop()
+
+        return result
+
+
+def serve_worker(fd):
+    """the isolated worker process loop, runs plugin calls until the monitor closes the socket"""
+    conn = Connection(fd)
+
+    while(True):
+        try:
+            path, function, args = conn.recv()
+        except EOFError:
+            return
+
+        conn.send(call_plugin(path, function, args))
+
+
+if __name__ == '__main__':
+    # leave stopping to the monitor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    serve_worker(int(sys.argv[1]))
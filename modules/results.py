@@ -0,0 +1,52 @@
+"""
+results.py
+
+In memory copy of the last result of each service check
+
+"""
+from threading import Lock
+
+
+class ResultStore:
+    """
+    Holds the last state of every service, keyed by the service id. This is everything needed to work out
+    service state transitions so the database doesn't need to be read on each check. It's seeded from the database
+    on startup and then updated with each new result.
+    """
+    FIELDS = ('return_code', 'state', 'check_attempt', 'last_state_change')
+
+    _results = None
+    _lock = None
+
+    def __init__(self):
+        self._results = {}
+        self._lock = Lock()
+
+    def load(self, services):
+        """
+        Loads the initial service results
+
+        :param services: list of service dicts, as saved in the database
+        """
+        for s in services:
+            self.update(s)
+
+    def get(self, service_id):
+        """
+        :param service_id: a valid service id
+
+        :returns: a dict with the last result of this service, empty if it hasn't been checked
+        """
+        with self._lock:
+            return self._results.get(service_id, {})
+
+    def update(self, service):
+        """
+        Saves the result of a service check
+
+        :param service: the service result dict
+        """
+        result = {k: service[k] for k in self.FIELDS}
+
+        with self._lock:
+            self._results[service['id']] = result
@@ -0,0 +1,350 @@
+"""
+runner.py
+
+Runs service check commands as subprocesses. All commands are started and awaited from a single
+asyncio event loop running in a background thread so that waiting on a check does not tie up an OS thread.
+Where supported commands are started by the modules.spawner helper process instead of forking the monitor.
+Python plugin checks are handed off to modules.plugins from the same loop.
+
+"""
+import asyncio
+import collections
+import itertools
+import json
+import logging
+import os
+import signal
+import threading
+import time
+import modules.spawner as spawner
+from modules.plugins import PythonCall, PythonPlugins
+
+# return code used when a check is killed for running too long
+TIMEOUT_RETURN_CODE = 3
+
+# seconds to wait for a killed check to exit before giving up on it
+KILL_WAIT = 5
+
+
+class ProcessResult:
+    """
+    The result of a completed service check command. Has the same attributes as
+    subprocess.CompletedProcess so it can be used in the same way
+    """
+    args = None
+    returncode = None
+    stdout = ""
+    stderr = ""
+    usage = None
+    shared = False
+
+    def __init__(self, args, returncode, stdout, stderr, usage=None, shared=False):
+        """
+        :param shared: true if this is the result of an identical command run for another service
+        """
+        self.args = args
+        self.returncode = returncode
+        self.stdout = stdout
+        self.stderr = stderr
+        self.usage = usage if usage is not None else make_usage(0)
+        self.shared = shared
+
+
+def make_usage(wall_time, rusage=None):
+    """
+    Resource usage of a check process as a dict. CPU times and peak memory are only available
+    when the process was started by the spawn server
+
+    :param wall_time: how long the process ran, in seconds
+    :param rusage: resource usage from os.wait4(), if available
+    """
+    result = {"wall_time": wall_time, "user_time": None, "system_time": None, "max_rss": None}
+
+    if(rusage is not None):
+        result['user_time'] = rusage.ru_utime
+        result['system_time'] = rusage.ru_stime
+        result['max_rss'] = rusage.ru_maxrss  # in KB
+
+    return result
+
+
+# resource usage sent back by the spawn server, same names as the os.wait4() result
+SpawnUsage = collections.namedtuple('SpawnUsage', ['ru_utime', 'ru_stime', 'ru_maxrss'])
+
+
+class SpawnedProcess:
+    """
+    A command started by the spawn server. Output is added as it arrives, the done future is
+    set once the command has finished and the return code and resource usage are known
+    """
+    request_id = None
+    stdout = None
+    stderr = None
+    returncode = None
+    rusage = None
+    error = None
+    done = None
+
+    def __init__(self, request_id, loop):
+        self.request_id = request_id
+        self.stdout = bytearray()
+        self.stderr = bytearray()
+        self.done = loop.create_future()
+
+    def finish(self, result):
+        """
+        :param result: the exit dict from the spawn server
+        """
+        if('error' in result):
+            self.error = result['error']
+        else:
+            self.returncode = result['returncode']
+            self.rusage = SpawnUsage(result['ru_utime'], result['ru_stime'], result['ru_maxrss'])
+
+        if(not self.done.done()):
+            self.done.set_result(True)
+
+
+class SpawnClient:
+    """
+    Sends commands to the spawn server and reads back their output. Must only be used from the
+    ServiceRunner event loop. If the server stops, any running commands fail and it is started again on the next spawn.
+    """
+    _reader = None
+    _writer = None
+    _reading = None
+    _connecting = None
+    _processes = None
+    _ids = None
+
+    def __init__(self):
+        self._connecting = asyncio.Lock()
+        self._processes = {}
+        self._ids = itertools.count(1)
+
+    async def spawn(self, command):
+        """
+        Starts a command
+
+        :param command: the command and arguments as a list
+
+        :returns: a SpawnedProcess
+        """
+        async with self._connecting:
+            if(self._writer is None):
+                self._reader, self._writer = await asyncio.open_unix_connection(sock=spawner.start_server())
+                self._reading = asyncio.get_running_loop().create_task(self.__read(self._reader, self._writer))
+
+        result = SpawnedProcess(next(self._ids) & 0xFFFFFFFF, asyncio.get_running_loop())
+        self._processes[result.request_id] = result
+        self._writer.write(spawner.make_frame(result.request_id, spawner.SPAWN, json.dumps(command).encode()))
+
+        return result
+
+    def kill(self, process):
+        """kills the process group of a running command"""
+        if(self._writer is not None and process.request_id in self._processes):
+            self._writer.write(spawner.make_frame(process.request_id, spawner.KILL))
+
+    async def __read(self, reader, writer):
+        """reads frames from the server until it stops"""
+        try:
+            while(True):
+                request_id, frame_type, length = spawner.FRAME_HEADER.unpack(await reader.readexactly(spawner.FRAME_HEADER.size))
+                payload = await reader.readexactly(length)
+                process = self._processes.get(request_id)
+
+                if(process is None):
+                    continue
+
+                if(frame_type == spawner.STDOUT):
+                    process.stdout.extend(payload)
+                elif(frame_type == spawner.STDERR):
+                    process.stderr.extend(payload)
+                elif(frame_type == spawner.EXIT):
+                    del self._processes[request_id]
+                    process.finish(json.loads(payload))
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            logging.error(f"Spawn server stopped: {e}")
+
+        # fail anything still running, the server is started again on the next spawn
+        self._reader, self._writer = None, None
+        writer.close()
+        spawner.stop_server()
+
+        for process in self._processes.values():
+            process.finish({"error": "Spawn server stopped"})
+        self._processes = {}
+
+
+class ServiceRunner:
+    """
+    Runs service check commands from an asyncio event loop. Each command is given a timeout, if it runs
+    longer than this the whole process group is killed and an Unknown (3) result is returned.
+    No more than max_processes commands will run at one time.
+
+    Identical commands are only run once per check cycle, anything else running the same command
+    in the cycle shares its result. If cache_ttl is set results are also reused in later cycles
+    until they are that many seconds old.
+    """
+    max_processes = 8
+    cache_ttl = 0
+    _loop = None
+    _thread = None
+    _slots = None
+    _spawner = None
+    _plugins = None
+    _cycle = 0
+    _shared = None
+
+    def __init__(self, max_processes):
+        self.max_processes = max_processes
+        self._plugins = PythonPlugins(max_processes)
+        self._shared = {}
+
+        if(spawner.is_supported()):
+            # start the spawn server now, before the runner or web threads are started
+            spawner.start_server()
+            self._spawner = SpawnClient()
+
+        # run the event loop in the background
+        self._loop = asyncio.new_event_loop()
+        self._slots = asyncio.Semaphore(self.max_processes)
+        self._thread = threading.Thread(name='Service Runner', target=self._loop.run_forever, daemon=True)
+        self._thread.start()
+
+    def run(self, command, timeout):
+        """
+        Runs a single command and blocks until it completes
+
+        :param command: the command and arguments as a list, or a PythonCall
+        :param timeout: how long the command is allowed to run, in seconds
+
+        :returns: a ProcessResult with the command output
+        """
+        return self.run_all([(command, timeout)], 1)[0]
+
+    def run_all(self, calls, limit):
+        """
+        Runs a group of commands concurrently and blocks until they have all completed
+
+        :param calls: list of (command, timeout) tuples, the command can be a list or a PythonCall
+        :param limit: the max number of these commands to run at once
+
+        :returns: a list of ProcessResult objects, in the same order as the calls
+        """
+        future = asyncio.run_coroutine_threadsafe(self.__gather(calls, limit), self._loop)
+
+        return future.result()
+
+    def new_cycle(self):
+        """starts a new check cycle, results from earlier cycles are only reused within the cache_ttl"""
+        self._loop.call_soon_threadsafe(self.__new_cycle)
+
+    def reload_plugins(self):
+        """Python plugins are loaded again the next time they are called, use when the config is reloaded"""
+        self._plugins.clear()
+
+    async def __gather(self, calls, limit):
+        group_slots = asyncio.Semaphore(limit)
+
+        async def limited(command, timeout):
+            async with group_slots:
+                return await self.__run_shared(command, timeout)
+
+        return await asyncio.gather(*[limited(command, timeout) for command, timeout in calls])
+
+    def __new_cycle(self):
+        now = time.monotonic()
+        self._cycle = self._cycle + 1
+
+        # drop finished results that are too old to use again
+        for key in [k for k, v in self._shared.items() if v['finished'] is not None and now - v['finished'] > self.cache_ttl]:
+            del self._shared[key]
+
+    async def __run_shared(self, command, timeout):
+        """runs the command, or waits on the result of the same command if it was already started this cycle"""
+        key = command if isinstance(command, PythonCall) else tuple(command)
+        entry = self._shared.get(key)
+
+        if(entry is not None and (entry['finished'] is None or entry['cycle'] == self._cycle or
+                                  time.monotonic() - entry['finished'] <= self.cache_ttl)):
+            logging.debug(f"Using shared result for {command}")
+            result = await asyncio.shield(entry['task'])
+
+            return ProcessResult(result.args, result.returncode, result.stdout, result.stderr, result.usage, True)
+
+        entry = {"cycle": self._cycle, "finished": None, "task": asyncio.ensure_future(self.__execute(command, timeout))}
+        entry['task'].add_done_callback(lambda t: entry.update(finished=time.monotonic()))
+        self._shared[key] = entry
+
+        return await asyncio.shield(entry['task'])
+
+    async def __execute(self, command, timeout):
+        """runs the command in its own process group, killing the group if the timeout is hit"""
+        async with self._slots:
+            logging.debug(command)
+
+            if(isinstance(command, PythonCall)):
+                returncode, output, usage = await self._plugins.run(command, timeout)
+                return ProcessResult(command, returncode, output, "", usage)
+
+            if(self._spawner is not None):
+                return await self.__spawn(command, timeout)
+
+            start = time.monotonic()
+            try:
+                proc = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+                                                            start_new_session=True)
+            except OSError as e:
+                return ProcessResult(command, 3, f"Error running check: {e}", str(e))
+
+            try:
+                stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+            except asyncio.TimeoutError:
+                logging.warning(f"Check timed out after {timeout} seconds: {command}")
+                self.__kill(proc)
+
+                try:
+                    await asyncio.wait_for(proc.wait(), KILL_WAIT)
+                except asyncio.TimeoutError:
+                    logging.error(f"Check did not exit {KILL_WAIT} seconds after being killed: {command}")
+
+                return ProcessResult(command, TIMEOUT_RETURN_CODE, f"Check timed out after {timeout} seconds", "",
+                                     make_usage(time.monotonic() - start))
+
+        return ProcessResult(command, proc.returncode, stdout.decode('utf-8', errors='replace'), stderr.decode('utf-8', errors='replace'),
+                             make_usage(time.monotonic() - start))
+
+    async def __spawn(self, command, timeout):
+        """runs the command through the spawn server, killing its process group if the timeout is hit"""
+        start = time.monotonic()
+        proc = await self._spawner.spawn(command)
+
+        try:
+            await asyncio.wait_for(asyncio.shield(proc.done), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Check timed out after {timeout} seconds: {command}")
+            self._spawner.kill(proc)
+
+            try:
+                await asyncio.wait_for(asyncio.shield(proc.done), KILL_WAIT)
+            except asyncio.TimeoutError:
+                logging.error(f"Check did not exit {KILL_WAIT} seconds after being killed: {command}")
+
+            return ProcessResult(command, TIMEOUT_RETURN_CODE, f"Check timed out after {timeout} seconds", "",
+                                 make_usage(time.monotonic() - start, proc.rusage))
+
+        if(proc.error is not None):
+            return ProcessResult(command, 3, f"Error running check: {proc.error}", proc.error)
+
+        return ProcessResult(command, proc.returncode, proc.stdout.decode('utf-8', errors='replace'), proc.stderr.decode('utf-8', errors='replace'),
+                             make_usage(time.monotonic() - start, proc.rusage))
+
+    def __kill(self, proc):
+        """kills the process group started with the process, this gets any children it started as well"""
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # process already finished
+            pass
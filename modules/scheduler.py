@@ -0,0 +1,185 @@
+"""
+scheduler.py
+
+Keeps track of when each host is next due for a check, and places checks so they are spread out evenly
+
+"""
+import heapq
+import time
+import threading
+import zlib
+
+
+class CheckScheduler:
+    """
+    Orders hosts by the time their next check is due using a heap. Due times are unix timestamps.
+    Rescheduling a host leaves its old heap entry in place, these stale entries are skipped
+    when they reach the top of the heap.
+
+    Each host is also given a phase, a fixed offset within its check interval. Hosts with the same
+    interval are spaced evenly across it, ordered by a hash of their id so the order doesn't change
+    between restarts. Checks are placed on the host's phase instead of at a random time.
+    """
+    _heap = None
+    _due = None
+    _phases = None
+    _wakeup = None
+
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+        self._phases = {}
+        self._wakeup = threading.Condition()
+
+    def set_phases(self, intervals):
+        """
+        Works out the phase of every host, replacing any existing phases
+
+        :param intervals: dict of host id to the check interval, in seconds
+        """
+        groups = {}
+        for host_id, interval in intervals.items():
+            groups.setdefault(interval, []).append(host_id)
+
+        phases = {}
+        for interval, host_ids in groups.items():
+            host_ids.sort(key=lambda h: (zlib.crc32(h.encode()), h))
+
+            for i, host_id in enumerate(host_ids):
+                phases[host_id] = (interval * i / len(host_ids), interval)
+
+        self._phases = phases
+
+    def get_phase(self, host_id):
+        """:returns: tuple of the phase offset and interval of the host, in seconds"""
+        return self._phases[host_id]
+
+    def next_slot(self, host_id, now=None):
+        """
+        Finds the next check time on the host's phase. This is normally one interval after the last slot,
+        if the host was checked off phase (by check_now) it is at least half an interval away
+
+        :param host_id: a valid host id
+        :param now: unix timestamp of the last check, the current time by default
+
+        :returns: unix timestamp of the next check
+        """
+        now = time.time() if now is None else now
+        offset, interval = self._phases[host_id]
+
+        result = now - ((now - offset) % interval) + interval
+        if(result - now < interval / 2):
+            result = result + interval
+
+        return result
+
+    def ramp_slot(self, host_id, window, now=None):
+        """
+        Places a first check within the ramp up window. Hosts are spread across the window in the same
+        order as their phase, so not every host is checked at once on startup
+
+        :param host_id: a valid host id
+        :param window: the length of the ramp up window, in seconds
+        :param now: unix timestamp the window starts at, the current time by default
+
+        :returns: unix timestamp of the first check
+        """
+        now = time.time() if now is None else now
+        offset, interval = self._phases[host_id]
+
+        return now + window * offset / interval
+
+    def get_load(self, weights=None, minutes=60):
+        """
+        The expected number of checks started in each minute, when every host is checked on its phase
+
+        :param weights: dict of host id to the number of checks run for the host, 1 for each host by default
+        :param minutes: the number of minutes to report on
+
+        :returns: list of the expected checks for each minute
+        """
+        result = [0] * minutes
+
+        for host_id, (offset, interval) in self._phases.items():
+            weight = weights.get(host_id, 1) if weights is not None else 1
+
+            slot = offset
+            while(slot < minutes * 60):
+                result[int(slot // 60)] = result[int(slot // 60)] + weight
+                slot = slot + interval
+
+        return result
+
+    def schedule(self, host_id, due_time):
+        """
+        Sets when the host is next due, replacing any current due time. Anything blocked in wait()
+        is woken up if this is now the earliest deadline
+
+        :param host_id: a valid host id
+        :param due_time: unix timestamp of the next check
+        """
+        with self._wakeup:
+            self._due[host_id] = due_time
+            heapq.heappush(self._heap, (due_time, host_id))
+
+            self.__drop_stale()
+            if(self._heap[0] == (due_time, host_id)):
+                self._wakeup.notify_all()
+
+    def remove(self, host_id):
+        """removes the host from the schedule"""
+        with self._wakeup:
+            self._due.pop(host_id, None)
+
+    def get_due_time(self, host_id):
+        """:returns: the unix timestamp when this host is due, None if not scheduled"""
+        return self._due.get(host_id)
+
+    def next_due(self):
+        """:returns: the unix timestamp of the earliest deadline, None if nothing is scheduled"""
+        with self._wakeup:
+            self.__drop_stale()
+
+            return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now=None):
+        """
+        Removes all hosts that are due from the schedule. Hosts must be scheduled again
+        once they are checked
+
+        :param now: unix timestamp to compare against, the current time by default
+
+        :returns: list of host ids that are due, in the order they became due
+        """
+        result = []
+        now = time.time() if now is None else now
+
+        with self._wakeup:
+            self.__drop_stale()
+            while(self._heap and self._heap[0][0] <= now):
+                _, host_id = heapq.heappop(self._heap)
+                del self._due[host_id]
+                result.append(host_id)
+
+                self.__drop_stale()
+
+        return result
+
+    def wait(self, max_wait):
+        """
+        Blocks until the next deadline is reached, a new earlier deadline is scheduled, or
+        max_wait seconds pass
+
+        :param max_wait: the longest time to wait, in seconds
+        """
+        with self._wakeup:
+            next_due = self.next_due()
+            wait_time = max_wait if next_due is None else min(max_wait, next_due - time.time())
+
+            if(wait_time > 0):
+                self._wakeup.wait(wait_time)
+
+    def __drop_stale(self):
+        """pops heap entries that no longer match the host's current due time"""
+        while(self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]):
+            heapq.heappop(self._heap)
@@ -0,0 +1,225 @@
+"""
+spawner.py
+
+A small helper process that starts service check commands for the monitor. Forking the main process copies
+its whole address space, the helper is started as a fresh interpreter with none of the web or database
+libraries loaded and starts each command with posix_spawn. It talks to the monitor over a socket pair,
+output from each command is streamed back followed by its return code and resource usage.
+
+This file is run directly as the helper process so it should only import from the standard library.
+
+"""
+import json
+import os
+import selectors
+import signal
+import socket
+import struct
+import subprocess
+import sys
+
+# each frame is the request id, frame type, and payload length followed by the payload
+FRAME_HEADER = struct.Struct("!IBI")
+
+# monitor -> spawn server
+SPAWN = 1  # payload is a JSON list of the command and arguments
+KILL = 2  # no payload, kills the process group of the command
+# spawn server -> monitor
+STDOUT = 3
+STDERR = 4
+EXIT = 5  # payload is a JSON dict of the return code and resource usage, or an error
+
+READ_SIZE = 65536
+RESET_SIGNALS = (signal.SIGINT, signal.SIGPIPE, signal.SIGXFSZ)
+
+# the running server process and the socket connected to it
+_server = None
+
+
+def is_supported():
+    """the spawn server needs posix_spawn and pid file descriptors, otherwise commands are started directly"""
+    return hasattr(os, 'posix_spawnp') and hasattr(os, 'pidfd_open')
+
+
+def start_server():
+    """
+    Starts the spawn server if it isn't already running. The server is a new interpreter so this doesn't copy
+    the monitor's memory, but it should still be called before any other threads are started.
+
+    :returns: the socket connected to the server
+    """
+    global _server
+
+    if(_server is None):
+        parent, child = socket.socketpair()
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), str(child.fileno())], pass_fds=[child.fileno()],
+                                   stdin=subprocess.DEVNULL)
+        child.close()
+
+        _server = (process, parent)
+
+    return _server[1]
+
+
+def stop_server():
+    """stops the spawn server, a new one is started on the next call to start_server()"""
+    global _server
+
+    if(_server is not None):
+        process, sock = _server
+        _server = None
+
+        process.kill()
+        process.wait()
+        sock.close()
+
+
+def make_frame(request_id, frame_type, payload=b""):
+    return FRAME_HEADER.pack(request_id, frame_type, len(payload)) + payload
+
+
+class SpawnServer:
+    """
+    The helper process loop. Reads spawn and kill requests from the monitor and watches the output pipes
+    and pid file descriptors of the running commands. A command is finished as soon as it exits, any output
+    already in its pipes is sent and the pipes are closed. Background processes it started that still hold
+    the pipes open don't keep the command running.
+    """
+    _sock = None
+    _selector = None
+    _buffer = None
+    _children = None
+
+    def __init__(self, fd):
+        self._sock = socket.socket(fileno=fd)
+        self._sock.set_inheritable(False)
+        self._selector = selectors.DefaultSelector()
+        self._buffer = b""
+        self._children = {}
+
+    def serve(self):
+        self._selector.register(self._sock, selectors.EVENT_READ, None)
+
+        while(True):
+            for key, _ in self._selector.select():
+                if(self._selector.get_map().get(key.fd) is not key):
+                    # the pipes of a command are closed when it exits, skip any of their events from the same select
+                    continue
+
+                if(key.data is None):
+                    if(not self.__read_requests()):
+                        # the monitor has gone away
+                        return
+                else:
+                    request_id, frame_type = key.data
+                    if(frame_type == EXIT):
+                        self.__reap(request_id, key.fd)
+                    else:
+                        self.__read_output(request_id, frame_type, key.fd)
+
+    def __send(self, request_id, frame_type, payload=b""):
+        self._sock.sendall(make_frame(request_id, frame_type, payload))
+
+    def __read_requests(self):
+        data = self._sock.recv(READ_SIZE)
+
+        if(not data):
+            return False
+
+        self._buffer = self._buffer + data
+        while(len(self._buffer) >= FRAME_HEADER.size):
+            request_id, frame_type, length = FRAME_HEADER.unpack_from(self._buffer)
+
+            if(len(self._buffer) < FRAME_HEADER.size + length):
+                break
+
+            payload = self._buffer[FRAME_HEADER.size:FRAME_HEADER.size + length]
+            self._buffer = self._buffer[FRAME_HEADER.size + length:]
+
+            if(frame_type == SPAWN):
+                self.__spawn(request_id, json.loads(payload))
+            elif(frame_type == KILL and request_id in self._children):
+                try:
+                    os.killpg(self._children[request_id]['pid'], signal.SIGKILL)
+                except ProcessLookupError:
+                    pass
+
+        return True
+
+    def __spawn(self, request_id, command):
+        stdout_read, stdout_write = os.pipe()
+        stderr_read, stderr_write = os.pipe()
+
+        try:
+            # the command is started in its own session so the whole group can be killed, signals python ignores are reset
+            pid = os.posix_spawnp(command[0], command, os.environ, setsid=True, setsigdef=RESET_SIGNALS,
+                                  file_actions=[(os.POSIX_SPAWN_OPEN, 0, os.devnull, os.O_RDONLY, 0),
+                                                (os.POSIX_SPAWN_DUP2, stdout_write, 1), (os.POSIX_SPAWN_DUP2, stderr_write, 2)])
+        except OSError as e:
+            for fd in (stdout_read, stdout_write, stderr_read, stderr_write):
+                os.close(fd)
+
+            self.__send(request_id, EXIT, json.dumps({"error": str(e)}).encode())
+            return
+
+        os.close(stdout_write)
+        os.close(stderr_write)
+
+        # the pipes are drained without blocking once the command exits
+        os.set_blocking(stdout_read, False)
+        os.set_blocking(stderr_read, False)
+
+        pidfd = os.pidfd_open(pid)
+        self._children[request_id] = {"pid": pid, "pipes": {stdout_read: STDOUT, stderr_read: STDERR}}
+        self._selector.register(stdout_read, selectors.EVENT_READ, (request_id, STDOUT))
+        self._selector.register(stderr_read, selectors.EVENT_READ, (request_id, STDERR))
+        self._selector.register(pidfd, selectors.EVENT_READ, (request_id, EXIT))
+
+    def __read_output(self, request_id, frame_type, fd):
+        if(self.__drain(request_id, frame_type, fd)):
+            self.__close(fd)
+            del self._children[request_id]['pipes'][fd]
+
+    def __drain(self, request_id, frame_type, fd):
+        """sends what can be read from the pipe without blocking
+
+        :returns: True at the end of the output
+        """
+        while(True):
+            try:
+                data = os.read(fd, READ_SIZE)
+            except BlockingIOError:
+                return False
+
+            if(not data):
+                return True
+
+            self.__send(request_id, frame_type, data)
+
+    def __reap(self, request_id, pidfd):
+        """the command has exited, sends the rest of its output and then its result"""
+        child = self._children.pop(request_id)
+        _, status, rusage = os.wait4(child['pid'], 0)
+        self.__close(pidfd)
+
+        # anything the command wrote is already in the pipes
+        for fd, frame_type in child['pipes'].items():
+            self.__drain(request_id, frame_type, fd)
+            self.__close(fd)
+
+        self.__send(request_id, EXIT, json.dumps({"returncode": os.waitstatus_to_exitcode(status), "ru_utime": rusage.ru_utime,
+                                                  "ru_stime": rusage.ru_stime, "ru_maxrss": rusage.ru_maxrss}).encode())
+
+    def __close(self, fd):
+        self._selector.unregister(fd)
+        os.close(fd)
+
+
+if __name__ == '__main__':
+    # leave stopping to the monitor
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    try:
+        SpawnServer(int(sys.argv[1])).serve()
+    except (BrokenPipeError, ConnectionResetError):
+        pass
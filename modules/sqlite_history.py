@@ -0,0 +1,242 @@
+"""
+sqlite_history.py
+
+Saves host status and perf data to a local SQLite database file, for installs without a Redis Stack server
+
+"""
+import datetime
+import json
+import logging
+import queue
+import re
+import sqlite3
+import threading
+import time
+from modules.history import bucket_size, HostHistory, PERF_POINTS, PERF_RAW_RESOLUTION, PERF_RETENTION
+
+# aggregation types get_ts_columns() can work out in SQL
+SQL_AGGREGATIONS = {"avg": "AVG(value)", "sum": "SUM(value)", "min": "MIN(value)", "max": "MAX(value)",
+                    "range": "MAX(value) - MIN(value)", "count": "COUNT(value)"}
+
+# how often old perf data points are deleted, in seconds
+CLEANUP_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS hosts (id TEXT PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS services (id TEXT PRIMARY KEY, host_id TEXT NOT NULL, position INTEGER NOT NULL,
+                                     return_code INTEGER NOT NULL, data TEXT NOT NULL);
+CREATE INDEX IF NOT EXISTS services_host ON services (host_id, position);
+CREATE INDEX IF NOT EXISTS services_return_code ON services (return_code);
+CREATE TABLE IF NOT EXISTS service_tags (tag TEXT, service_id TEXT, PRIMARY KEY (tag, service_id)) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS service_tags_service ON service_tags (service_id);
+CREATE TABLE IF NOT EXISTS series (id TEXT PRIMARY KEY) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS perf_data (series TEXT, time INTEGER, value REAL, PRIMARY KEY (series, time)) WITHOUT ROWID;
+"""
+
+
+class SQLiteHistory(HostHistory):
+    """
+    Keeps the host status and perf data in a SQLite database in WAL mode, so pages can be read while checks
+    are saved. Each host is a row holding its status without the services, services are rows of their own indexed
+    by host, return code, and tag. Perf data points are rows keyed by series and time, kept for 30 days. Long time
+    ranges are aggregated in SQL instead of being averaged ahead of time.
+
+    Each thread opens its own connection. Host updates are only sent to listeners in this process.
+    """
+    aggregations = list(SQL_AGGREGATIONS.keys()) + ["first", "last"]
+    path = None
+    _local = None
+    _listeners = None
+    _lock = None
+    _last_cleanup = 0
+
+    def __init__(self, path):
+        """
+        :param path: path to the database file, created if it doesn't exist
+        """
+        self.path = path
+        self._local = threading.local()
+        self._listeners = []
+        self._lock = threading.Lock()
+
+        with self.__connect() as db:
+            db.executescript(SCHEMA)
+
+    def save_last_check(self):
+        with self.__connect() as db:
+            db.execute("INSERT OR REPLACE INTO settings (key, value) VALUES ('last_check', ?)", (json.dumps(time.time()),))
+
+    def get_last_check(self):
+        row = self.__connect().execute("SELECT value FROM settings WHERE key = 'last_check'").fetchone()
+
+        return datetime.datetime.fromtimestamp(json.loads(row[0]) if row is not None else 0)
+
+    def list_hosts(self):
+        return [r[0] for r in self.__connect().execute("SELECT id FROM hosts ORDER BY id")]
+
+    def get_hosts(self):
+        return [json.loads(r[0]) for r in self.__connect().execute("SELECT data FROM hosts ORDER BY id")]
+
+    def get_host(self, host_id):
+        db = self.__connect()
+        row = db.execute("SELECT data FROM hosts WHERE id = ?", (host_id,)).fetchone()
+        if(row is None):
+            return {}
+
+        result = json.loads(row[0])
+        result['services'] = [json.loads(r[0]) for r in db.execute("SELECT data FROM services WHERE host_id = ? ORDER BY position", (host_id,))]
+
+        return result
+
+    def get_tag(self, tag_id):
+        rows = self.__connect().execute("""SELECT s.data FROM service_tags t JOIN services s ON s.id = t.service_id
+                                           WHERE t.tag = ? ORDER BY s.id""", (tag_id,))
+
+        return {"id": tag_id, "services": [json.loads(r[0]) for r in rows]}
+
+    def get_services(self, return_codes=[0], service_filter=".*"):
+        return_codes = [int(r) for r in return_codes]
+        rows = self.__connect().execute(f"SELECT id, data FROM services WHERE return_code IN ({','.join('?' * len(return_codes))}) ORDER BY id",
+                                        return_codes)
+
+        # filter the ids before loading the services
+        pattern = re.compile(service_filter)
+        return [json.loads(data) for service_id, data in rows if pattern.search(service_id)]
+
+    def get_service(self, service_id):
+        row = self.__connect().execute("SELECT data FROM services WHERE id = ?", (service_id,)).fetchone()
+
+        return json.loads(row[0]) if row is not None else {}
+
+    def get_ts_columns(self, key, start, end, points=PERF_POINTS, aggregation=None, bucket=None):
+        """ gets the values of a perf data series within a time range. When there would be more than the requested
+        number of points they are averaged into larger buckets in SQL, see HostHistory.get_ts_columns() """
+        bucket = bucket_size(start, end, points, bucket)
+        if(aggregation is None and bucket > PERF_RAW_RESOLUTION):
+            aggregation = "avg"
+
+        db = self.__connect()
+        args = {"series": key, "start": start * 1000, "end": end * 1000, "bucket": bucket}
+
+        if(aggregation is None):
+            bucket = 0
+            rows = db.execute("SELECT time, value FROM perf_data WHERE series = :series AND time BETWEEN :start AND :end ORDER BY time", args)
+        elif(aggregation in ["first", "last"]):
+            # SQLite takes the value from the row with the min or max time
+            rows = db.execute(f"""SELECT (time / :bucket) * :bucket AS bucket_time, value, {'MIN' if aggregation == 'first' else 'MAX'}(time)
+                                  FROM perf_data WHERE series = :series AND time BETWEEN :start AND :end
+                                  GROUP BY bucket_time ORDER BY bucket_time""", args)
+        else:
+            rows = db.execute(f"""SELECT (time / :bucket) * :bucket AS bucket_time, {SQL_AGGREGATIONS[aggregation]}
+                                  FROM perf_data WHERE series = :series AND time BETWEEN :start AND :end
+                                  GROUP BY bucket_time ORDER BY bucket_time""", args)
+
+        return self._to_columns([r[:2] for r in rows], bucket)
+
+    def get_raw_ts_columns(self, key, start, end):
+        """ gets every point of the series within a time range, see HostHistory.get_raw_ts_columns() """
+        rows = self.__connect().execute("SELECT time, value FROM perf_data WHERE series = ? AND time BETWEEN ? AND ? ORDER BY time",
+                                        (key, start * 1000, end * 1000))
+
+        return self._to_columns(list(rows), 0)
+
+    def list_series(self):
+        return [r[0] for r in self.__connect().execute("SELECT id FROM series ORDER BY id")]
+
+    def set_hosts(self, host_ids):
+        old_hosts = list(set(self.list_hosts()) - set(host_ids))
+
+        with self.__connect() as db:
+            for host_id in old_hosts:
+                self.__delete_host(db, host_id)
+
+        if(old_hosts):
+            self.__publish_update(old_hosts)
+
+    def listen_updates(self):
+        """ waits for hosts to be saved or deleted by this process, see HostHistory.listen_updates() """
+        updates = queue.Queue()
+        with self._lock:
+            self._listeners.append(updates)
+
+        # nothing is missed after this point
+        yield None
+
+        while(True):
+            yield updates.get()
+
+    def save_hosts(self, batch, update_perf_data=True):
+        """ saves a batch of host statuses, such as all the hosts checked in one cycle. All the hosts, their services,
+        and their perf data points are written in one transaction
+
+        :param batch: list of host status dicts
+        :param update_perf_data: if the perf data for each service should be added to its time series
+        """
+        if(not batch):
+            return
+
+        with self.__connect() as db:
+            for host_status in batch:
+                self.__delete_host(db, host_status['id'])
+
+                host = {k: v for k, v in host_status.items() if k != 'services'}
+                db.execute("INSERT INTO hosts (id, data) VALUES (?, ?)", (host_status['id'], json.dumps(host)))
+                db.executemany("INSERT INTO services (id, host_id, position, return_code, data) VALUES (?, ?, ?, ?, ?)",
+                               [(s['id'], host_status['id'], i, s['return_code'], json.dumps(s)) for i, s in enumerate(host_status['services'])])
+                db.executemany("INSERT OR IGNORE INTO service_tags (tag, service_id) VALUES (?, ?)",
+                               [(t, s['id']) for s in host_status['services'] for t in s.get('tags', [])])
+
+            if(update_perf_data):
+                self.__insert_perf_data(db, batch)
+
+        self.__publish_update([h['id'] for h in batch])
+
+    def save_perf_data(self, batch):
+        """ adds the perf data of each host status to its time series, in one transaction
+
+        :param batch: list of host status dicts
+        """
+        if(not batch):
+            return
+
+        with self.__connect() as db:
+            self.__insert_perf_data(db, batch)
+
+    def __connect(self):
+        """ :returns: the connection for the current thread, opened on first use """
+        if(getattr(self._local, 'db', None) is None):
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+
+        return self._local.db
+
+    def __insert_perf_data(self, db, batch):
+        # time series use millisecond timestamps, a point saved again with the same time replaces the old one
+        perf_data = [(p['id'], int(h['last_check'] * 1000), p['value']) for h in batch for s in h['services'] for p in s.get('perf_data', [])]
+        db.executemany("INSERT OR REPLACE INTO perf_data (series, time, value) VALUES (?, ?, ?)", perf_data)
+        db.executemany("INSERT OR IGNORE INTO series (id) VALUES (?)", [(p[0],) for p in perf_data])
+
+        if(time.time() - self._last_cleanup > CLEANUP_INTERVAL):
+            self.__delete_old_perf_data(db)
+
+    def __delete_host(self, db, host_id):
+        db.execute("DELETE FROM service_tags WHERE service_id IN (SELECT id FROM services WHERE host_id = ?)", (host_id,))
+        db.execute("DELETE FROM services WHERE host_id = ?", (host_id,))
+        db.execute("DELETE FROM hosts WHERE id = ?", (host_id,))
+
+    def __delete_old_perf_data(self, db):
+        """ deletes points past the retention period, one series at a time so each delete uses the primary key """
+        self._last_cleanup = time.time()
+        cutoff = int(self._last_cleanup * 1000) - PERF_RETENTION
+
+        series = [r[0] for r in db.execute("SELECT id FROM series")]
+        db.executemany("DELETE FROM perf_data WHERE series = ? AND time < ?", [(s, cutoff) for s in series])
+        logging.debug(f"Deleted performance data older than {datetime.datetime.fromtimestamp(cutoff / 1000)}")
+
+    def __publish_update(self, host_ids):
+        with self._lock:
+            for updates in self._listeners:
+                updates.put(host_ids)
@@ -0,0 +1,108 @@
+"""
+stats.py
+
+Tracks the resources used by service check commands
+
+"""
+import time
+from threading import Lock
+
+# valid values to sort the most expensive checks by
+SORT_KEYS = ('cpu_time', 'wall_time', 'max_rss')
+
+
+class CheckStats:
+    """
+    Aggregates the resource usage of each check command. Usage is summed per service id in time buckets so
+    the cost of checks can be compared over a recent window. Buckets older than the retention period are dropped.
+    """
+    bucket_size = 600
+    retention = 86400
+    _buckets = None
+    _lock = None
+
+    def __init__(self, bucket_size=600, retention=86400):
+        """
+        :param bucket_size: length of each time bucket, in seconds
+        :param retention: how long to keep usage information, in seconds
+        """
+        self.bucket_size = bucket_size
+        self.retention = retention
+        self._buckets = {}
+        self._lock = Lock()
+
+    def record(self, service_id, service_type, host_id, usage):
+        """
+        Adds the resource usage of one check
+
+        :param service_id: the id of the service that was checked
+        :param service_type: the service definition type
+        :param host_id: the id of the host
+        :param usage: dict of resource usage from the ServiceRunner
+        """
+        bucket = int(time.time() // self.bucket_size)
+
+        with self._lock:
+            services = self._buckets.setdefault(bucket, {})
+            if(service_id not in services):
+                services[service_id] = {"id": service_id, "type": service_type, "host": host_id, "count": 0, "wall_time": 0,
+                                        "user_time": 0, "system_time": 0, "max_rss": 0}
+
+            total = services[service_id]
+            total['count'] = total['count'] + 1
+            total['wall_time'] = total['wall_time'] + usage['wall_time']
+            total['user_time'] = total['user_time'] + (usage['user_time'] or 0)
+            total['system_time'] = total['system_time'] + (usage['system_time'] or 0)
+            total['max_rss'] = max(total['max_rss'], usage['max_rss'] or 0)
+
+            # drop anything past the retention period
+            for old in [b for b in self._buckets if b < bucket - (self.retention // self.bucket_size)]:
+                del self._buckets[old]
+
+    def get_top(self, minutes=60, top=10, sort='cpu_time'):
+        """
+        Finds the most expensive checks over the last given minutes
+
+        :param minutes: the window to look at, rounded up to whole buckets
+        :param top: the number of results to return
+        :param sort: one of SORT_KEYS, cpu_time is user plus system time
+
+        :returns: dict with the top individual services and top service types
+        """
+        start = int((time.time() - minutes * 60) // self.bucket_size)
+        services = {}
+
+        with self._lock:
+            for bucket, totals in self._buckets.items():
+                if(bucket >= start):
+                    for service_id, total in totals.items():
+                        services[service_id] = self.__combine(services.get(service_id), total)
+
+        # roll up the services by type
+        types = {}
+        for s in services.values():
+            types[s['type']] = self.__combine(types.get(s['type']), {k: v for k, v in s.items() if k not in ['id', 'host']})
+
+        return {"minutes": minutes, "sort": sort,
+                "services": self.__sort(services.values(), top, sort), "types": self.__sort(types.values(), top, sort)}
+
+    def __combine(self, current, total):
+        result = dict(total)
+
+        if(current is not None):
+            for k in ['count', 'wall_time', 'user_time', 'system_time']:
+                result[k] = current[k] + total[k]
+            result['max_rss'] = max(current['max_rss'], total['max_rss'])
+
+        return result
+
+    def __sort(self, totals, top, sort):
+        result = []
+
+        for t in totals:
+            t['cpu_time'] = t['user_time'] + t['system_time']
+            t['avg_wall_time'] = t['wall_time'] / t['count']
+            t['avg_cpu_time'] = t['cpu_time'] / t['count']
+            result.append(t)
+
+        return sorted(result, key=lambda t: t[sort], reverse=True)[:top]
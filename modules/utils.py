@@ -4,6 +4,7 @@ utils.py
 Utility functions and variables for global use
 
 """
+import datetime
 import json
 import logging
 import markdown
@@ -120,6 +121,26 @@ def read_yaml(file):
     return result
 
 
+# format a unix timestamp for display using TIME_FORMAT, values that aren't timestamps are returned as is
+def format_timestamp(timestamp):
+    result = timestamp
+
+    if(isinstance(timestamp, (int, float)) and not isinstance(timestamp, bool) and timestamp > 0):
+        result = datetime.datetime.fromtimestamp(timestamp).strftime(TIME_FORMAT)
+
+    return result
+
+
+# convert a TIME_FORMAT string to a unix timestamp, values that aren't strings are returned as is
+def parse_timestamp(time_string):
+    result = time_string
+
+    if(isinstance(time_string, str)):
+        result = datetime.datetime.strptime(time_string, TIME_FORMAT).timestamp()
+
+    return result
+
+
 # write JSON to file
 def write_json(file, data):
     write_file(file, json.dumps(data))
@@ -0,0 +1,216 @@
+"""
+writer.py
+
+Saves host check results to the history database from a background thread, so a slow database doesn't hold up checks
+
+"""
+import logging
+import threading
+import time
+
+
+class HistoryWriter:
+    """
+    Queues host statuses and saves them to the HostHistory database in batches from its own thread. Statuses are
+    queued by host id, a host queued again before it is saved replaces the waiting status so only the latest is
+    written. The perf data of a replaced status is kept and added to its time series along with the batch. When
+    more than max_pending hosts are waiting put() blocks until the next batch is taken, slowing checks down to the
+    speed of the database instead of growing the queue.
+
+    Hosts are always saved whole, in the order they were queued, so the database only ever holds a complete
+    status for each host and never goes back to an older one.
+    """
+    max_pending = 1000
+    retry = 5
+    history = None
+    _pending = None
+    _flushing = None
+    _last_check = False
+    _changed = None
+    _listeners = None
+    _stats = None
+
+    def __init__(self, history, max_pending=1000, retry=5):
+        """
+        :param history: a HostHistory object to save to
+        :param max_pending: the most hosts waiting to be saved before put() blocks
+        :param retry: seconds to wait before saving again after an error
+        """
+        self.history = history
+        self.max_pending = max_pending
+        self.retry = retry
+        self._pending = {}
+        self._flushing = {}
+        self._changed = threading.Condition()
+        self._listeners = []
+        self._stats = {"queued": 0, "coalesced": 0, "saved": 0, "flushes": 0, "errors": 0, "blocked_time": 0,
+                       "last_flush_time": 0, "max_flush_time": 0, "total_flush_time": 0}
+
+        threading.Thread(name='History Writer', target=self.__run, daemon=True).start()
+
+    def add_listener(self, listener):
+        """
+        :param listener: function called with the list of host statuses from each batch, once they are saved
+        """
+        self._listeners.append(listener)
+
+    def put(self, batch, update_perf_data=True, last_check=True):
+        """
+        Queues the host statuses to be saved, blocking while the queue is full
+
+        :param batch: list of host status dicts
+        :param update_perf_data: if the perf data for each service should be added to its time series
+        :param last_check: if the last check time should be saved after these hosts
+        """
+        with self._changed:
+            for host_status in batch:
+                if(len(self._pending) >= self.max_pending and host_status['id'] not in self._pending):
+                    logging.warning(f"{len(self._pending)} hosts are waiting to be saved, pausing until the database catches up")
+                    start = time.time()
+                    self._changed.wait_for(lambda: len(self._pending) < self.max_pending)
+                    self._stats['blocked_time'] = self._stats['blocked_time'] + time.time() - start
+
+                self.__queue(host_status, update_perf_data)
+
+            self._last_check = self._last_check or last_check
+            self._changed.notify_all()
+
+    def update_host(self, host_id, changes):
+        """
+        Queues a change to some values of a saved host. The change is made to the latest status of the host,
+        even when this is still waiting to be saved
+
+        :param host_id: a valid host id
+        :param changes: dict of the host values to change
+        """
+        saved = None
+        while(True):
+            with self._changed:
+                latest = self.__latest(host_id)
+
+                # use the saved status only if nothing was queued or saved while reading it
+                if(latest is None and saved is not None and saved[1] == self._stats['flushes']):
+                    latest = saved[0]
+
+                if(latest is not None):
+                    if(latest):
+                        # the changed status has the same check time, its perf data is not saved again
+                        self.__queue(dict(latest, **changes), False)
+                        self._changed.notify_all()
+                    return
+
+                flushes = self._stats['flushes']
+
+            saved = (self.history.get_host(host_id), flushes)
+
+    def flush(self, timeout=None):
+        """
+        Blocks until every queued host is saved
+
+        :param timeout: the most seconds to wait, forever if None
+
+        :returns: True if everything was saved
+        """
+        with self._changed:
+            return self._changed.wait_for(lambda: not self._pending and not self._flushing and not self._last_check, timeout)
+
+    def get_stats(self):
+        """
+        :returns: dict of the number of hosts waiting to be saved (pending) and being saved (flushing), the number of
+        hosts queued, replaced by a newer status before being saved (coalesced), and saved, and the batch save times
+        in seconds
+        """
+        with self._changed:
+            result = dict(self._stats, pending=len(self._pending), flushing=len(self._flushing), max_pending=self.max_pending)
+
+        result['average_flush_time'] = result['total_flush_time'] / result['flushes'] if result['flushes'] > 0 else 0
+        return result
+
+    def __queue(self, host_status, update_perf_data):
+        """adds the host to the pending hosts, must hold the lock"""
+        entry = (host_status, update_perf_data, [])
+
+        old = self._pending.pop(host_status['id'], None)
+        if(old is not None):
+            self._stats['coalesced'] = self._stats['coalesced'] + 1
+            entry = self.__merge(old, entry)
+
+        self._pending[host_status['id']] = entry
+        self._stats['queued'] = self._stats['queued'] + 1
+
+    def __merge(self, old, new):
+        """
+        Replaces a queued entry with a newer one for the same host. Each entry is the host status, if its perf data
+        should be saved, and a list of older statuses whose perf data still has to be saved
+
+        :returns: the newer entry, with any perf data of the old entry that hasn't been saved
+        """
+        host_status, update_perf_data, older = new
+
+        if(old[0].get('last_check') == host_status.get('last_check')):
+            # the same check result with some values changed, its perf data points are the same
+            return (host_status, update_perf_data or old[1], old[2] + older)
+
+        return (host_status, update_perf_data, old[2] + ([old[0]] if old[1] else []) + older)
+
+    def __latest(self, host_id):
+        """the latest queued status of the host, waiting or being saved, None if there isn't one. Must hold the lock"""
+        entry = self._pending.get(host_id, self._flushing.get(host_id))
+
+        return entry[0] if entry is not None else None
+
+    def __run(self):
+        while(True):
+            with self._changed:
+                self._changed.wait_for(lambda: self._pending or self._last_check)
+
+                # take everything waiting as the next batch
+                self._flushing = self._pending
+                self._pending = {}
+                last_check = self._last_check
+                self._last_check = False
+                self._changed.notify_all()
+
+            start = time.time()
+            try:
+                batch = list(self._flushing.values())
+
+                # perf data of replaced statuses first, so points are added in the order they were checked
+                self.history.save_perf_data([h for _, _, older in batch for h in older])
+                self.history.save_hosts([h for h, perf, _ in batch if perf], update_perf_data=True)
+                self.history.save_hosts([h for h, perf, _ in batch if not perf], update_perf_data=False)
+
+                if(last_check):
+                    self.history.save_last_check()
+            except Exception:
+                logging.exception(f"Error saving {len(self._flushing)} hosts, trying again in {self.retry} seconds")
+
+                with self._changed:
+                    self._stats['errors'] = self._stats['errors'] + 1
+
+                    # put the batch back, behind any newer status queued in the meantime
+                    for host_id, entry in self._flushing.items():
+                        newer = self._pending.get(host_id)
+                        self._pending[host_id] = entry if newer is None else self.__merge(entry, newer)
+                    self._flushing = {}
+                    self._last_check = self._last_check or last_check
+                    self._changed.notify_all()
+
+                time.sleep(self.retry)
+                continue
+
+            elapsed = time.time() - start
+            with self._changed:
+                self._stats['saved'] = self._stats['saved'] + len(self._flushing)
+                self._stats['flushes'] = self._stats['flushes'] + 1
+                self._stats['last_flush_time'] = elapsed
+                self._stats['max_flush_time'] = max(self._stats['max_flush_time'], elapsed)
+                self._stats['total_flush_time'] = self._stats['total_flush_time'] + elapsed
+                self._flushing = {}
+                self._changed.notify_all()
+
+            for listener in self._listeners:
+                try:
+                    listener([h for h, _, _ in batch])
+                except Exception:
+                    logging.exception(f"Error sending saved hosts to {listener}")
@@ -0,0 +1,62 @@
+"""
+test_icmp.py
+
+Tests a ping sweep of a mix of hosts, needs permission to open an ICMP socket
+
+"""
+import re
+import socket
+import unittest
+from modules.icmp import PingSweep
+
+LOCALHOST = "127.0.0.1"
+UNROUTABLE = "240.0.0.1"  # reserved, never routed
+UNRESOLVABLE = "does-not-resolve.invalid"
+
+PERF_DATA_PATTERN = re.compile(r"^percent_packet_loss=[\d.]+% average_return_time=[\d.]+ms$")
+
+
+def can_ping():
+    for sock_type in (socket.SOCK_RAW, socket.SOCK_DGRAM):
+        try:
+            socket.socket(socket.AF_INET, sock_type, socket.IPPROTO_ICMP).close()
+            return True
+        except OSError:
+            pass
+
+    return False
+
+
+@unittest.skipUnless(can_ping(), "no permission to open an ICMP socket")
+class TestPingSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.pinger = PingSweep(count=9, timeout=0.2, interval=0.1)
+
+    def test_sweep(self):
+        result = self.pinger.sweep([LOCALHOST, UNROUTABLE, UNRESOLVABLE])
+
+        self.assertEqual(set(result.keys()), {LOCALHOST, UNROUTABLE, UNRESOLVABLE})
+        for address, r in result.items():
+            with self.subTest(address=address):
+                self.assertEqual(set(r.keys()), {"success", "performance_data"})
+                self.assertRegex(r['performance_data'], PERF_DATA_PATTERN)
+
+        self.assertTrue(result[LOCALHOST]['success'])
+        self.assertFalse(result[UNROUTABLE]['success'])
+        self.assertFalse(result[UNRESOLVABLE]['success'])
+        self.assertTrue(result[UNRESOLVABLE]['performance_data'].startswith("percent_packet_loss=1.0%"))
+
+    def test_stops_early(self):
+        self.pinger.sweep([LOCALHOST, UNROUTABLE])
+
+        # each request takes the next sequence number, localhost is up once a majority answer and isn't sent the rest
+        sent = next(self.pinger._sequence)
+        self.assertLess(sent, self.pinger.count * 2)
+
+    def test_ping(self):
+        self.assertTrue(self.pinger.ping(LOCALHOST)['success'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+"""
+test_perfdata.py
+
+Conformance tests for the perf data parser, using output in the formats described by the Nagios plugin guidelines
+https://nagios-plugins.org/doc/guidelines.html#AEN200
+
+"""
+import unittest
+from benchmarks.legacy_perfdata import legacy_parse_perf_data
+from modules.perfdata import get_perf_string, parse_perf_data
+
+SERVICE_ID = "host-service"
+
+# service output and the metrics it should be parsed to
+CORPUS = [
+    ("OK - all good", []),
+    ("OK - load average: 0.50, 0.30|load1=0.5;1;2;0; load5=0.3;1;2;0;",
+     [{"id": "host-service-load1", "label": "load1", "value": 0.5, "warning": 1.0, "critical": 2.0, "min": 0.0},
+      {"id": "host-service-load5", "label": "load5", "value": 0.3, "warning": 1.0, "critical": 2.0, "min": 0.0}]),
+    # quoted labels can have spaces, a quote in the label is doubled
+    ("DISK OK|'disk usage'=45%;80;90;0;100",
+     [{"id": "host-service-disk-usage", "label": "disk usage", "value": 45.0, "uom": "%", "warning": 80.0, "critical": 90.0,
+       "min": 0.0, "max": 100.0}]),
+    ("OK|'it''s here'=1",
+     [{"id": "host-service-it-s-here", "label": "it's here", "value": 1.0}]),
+    ("OK|'a=b'=2",
+     [{"id": "host-service-a-b", "label": "a=b", "value": 2.0}]),
+    # labels without any valid id characters use root
+    ("DISK OK|'/'=2643MB;5948;5958;0;5968",
+     [{"id": "host-service-root", "label": "/", "value": 2643.0, "uom": "MB", "warning": 5948.0, "critical": 5958.0, "min": 0.0,
+       "max": 5968.0}]),
+    # thresholds and min/max can be left empty
+    ("OK|time=0.2s;;;0;10",
+     [{"id": "host-service-time", "label": "time", "value": 0.2, "uom": "s", "min": 0.0, "max": 10.0}]),
+    ("OK|time=0.2s;;",
+     [{"id": "host-service-time", "label": "time", "value": 0.2, "uom": "s"}]),
+    # U is an undetermined value, the metric is skipped
+    ("UNKNOWN|a=U;1;2 b=3",
+     [{"id": "host-service-b", "label": "b", "value": 3.0}]),
+    # ranges only keep a plain start value, anything else is not a number
+    ("WARNING|temp=25C;@10:20;~:30",
+     [{"id": "host-service-temp", "label": "temp", "value": 25.0, "uom": "C"}]),
+    ("WARNING|temp=25C;10:20;30:",
+     [{"id": "host-service-temp", "label": "temp", "value": 25.0, "uom": "C", "warning": 10.0, "critical": 30.0}]),
+    # units of measure
+    ("OK|size=1024KB rate=5.5MB/s count=3c pct=99.9% wait=120ms",
+     [{"id": "host-service-size", "label": "size", "value": 1024.0, "uom": "KB"},
+      {"id": "host-service-rate", "label": "rate", "value": 5.5, "uom": "MB/s"},
+      {"id": "host-service-count", "label": "count", "value": 3.0, "uom": "c"},
+      {"id": "host-service-pct", "label": "pct", "value": 99.9, "uom": "%"},
+      {"id": "host-service-wait", "label": "wait", "value": 120.0, "uom": "ms"}]),
+    # signs and leading decimal points
+    ("OK|offset=-0.5s;.5;+1",
+     [{"id": "host-service-offset", "label": "offset", "value": -0.5, "uom": "s", "warning": 0.5, "critical": 1.0}]),
+    # perf data on the first line and after long text output
+    ("DISK OK - free space: / 3326 MB|/=2643MB;5948;5958;0;5968\n/ 15272 MB (77%);\n/boot 68 MB (69%);\n"
+     "| /boot=68MB;88;93;0;98\n/home=69357MB;253404;253409;0;253414",
+     [{"id": "host-service-root", "label": "/", "value": 2643.0, "uom": "MB", "warning": 5948.0, "critical": 5958.0, "min": 0.0,
+       "max": 5968.0},
+      {"id": "host-service-boot", "label": "/boot", "value": 68.0, "uom": "MB", "warning": 88.0, "critical": 93.0, "min": 0.0,
+       "max": 98.0},
+      {"id": "host-service-home", "label": "/home", "value": 69357.0, "uom": "MB", "warning": 253404.0, "critical": 253409.0,
+       "min": 0.0, "max": 253414.0}]),
+    # long text without more perf data
+    ("OK - first line|a=1\nsecond line\nthird line",
+     [{"id": "host-service-a", "label": "a", "value": 1.0}]),
+]
+
+# output the parser used before perfdata.py handled, both should give the same metrics
+PARITY = [output for output, _ in CORPUS if "\n" not in output and "''" not in output and "'a=b'" not in output and "=U" not in output]
+
+
+class TestPerfData(unittest.TestCase):
+
+    def test_corpus(self):
+        for output, expected in CORPUS:
+            with self.subTest(output=output):
+                self.assertEqual(parse_perf_data(SERVICE_ID, output), expected)
+
+    def test_legacy_parity(self):
+        for output in PARITY:
+            with self.subTest(output=output):
+                self.assertEqual(parse_perf_data(SERVICE_ID, output), legacy_parse_perf_data(SERVICE_ID, output))
+
+    def test_perf_string(self):
+        self.assertEqual(get_perf_string("OK"), "")
+        self.assertEqual(get_perf_string("OK|a=1\nlong text"), "a=1")
+        self.assertEqual(get_perf_string("OK|a=1\nlong text|b=2\nc=3"), "a=1 b=2\nc=3")
+
+
+if __name__ == '__main__':
+    unittest.main()